@@ -0,0 +1,356 @@
+"""
+Модуль работы с базой данных SQLite.
+Хранит одно долгоживущее подключение для записи и небольшой пул подключений только для чтения,
+чтобы обработчики бота не открывали и не закрывали файл базы данных на каждый запрос.
+"""
+
+# Импорт необходимых модулей:
+import queue                  # Для пула подключений только для чтения
+import sqlite3                # Для работы с базой данных SQLite
+import threading              # Для блокировки подключения на запись
+import time                   # Для кэширования строки текущего времени
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from urllib.parse import quote
+from state_store import TTLDict
+
+# Глобальные переменные, которые инициализируются функцией init_db из main.py:
+# DB_FILE - путь к файлу базы данных,
+# conn - единственное подключение для записи (используется из разных потоков под write_lock;
+#        блокировка повторно входимая, см. transaction),
+# _read_pool - очередь подключений только для чтения.
+DB_FILE = None
+conn = None
+write_lock = threading.RLock()
+_read_pool = None
+
+# Максимальный размер отображения файла БД в память (PRAGMA mmap_size), байт.
+MMAP_SIZE = 128 * 1024 * 1024
+
+# Размер кэша подготовленных запросов на одно подключение (по умолчанию в sqlite3 — 128).
+STATEMENT_CACHE_SIZE = 256
+
+# Повторные попытки начать транзакцию записи, если база занята другим процессом (ошибка "database is locked"
+# после истечения busy_timeout): LOCK_RETRIES попыток с паузой LOCK_RETRY_DELAY, удваивающейся после каждой.
+LOCK_RETRIES = 3
+LOCK_RETRY_DELAY = 0.1
+
+# Поддержка INSERT/UPDATE ... RETURNING появилась в SQLite 3.35.
+SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Последняя вычисленная строка текущего времени: (целая секунда time.time(), строка ISO).
+_now_cache = (None, None)
+
+# Кэш анкетных данных пользователей: tg_id -> (id, name, surname, apartment, phone) первой записи или None.
+# Пользователи часто нажимают кнопки повторно, а эти поля меняются только при заполнении анкеты,
+# поэтому код, изменяющий name/surname/apartment/phone, вызывает invalidate_user_profile.
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 300    # Время жизни записи кэша в секундах.
+_user_profile_cache = TTLDict(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# Соответствие chat_id -> houses.id. Домов (групповых чатов) немного и записи houses не удаляются,
+# поэтому таблица целиком загружается при запуске и дополняется по мере появления новых чатов.
+# В словарь попадают только зафиксированные записи: id дома, созданного в незавершённой транзакции,
+# мог бы достаться другому чату после отката.
+HOUSES = {}
+_houses_lock = threading.Lock()
+
+
+def now_iso():
+    """
+    Возвращает текущее время в формате ISO с точностью до секунды (например, "2025-03-01T12:00:05")
+    для полей date_add/date_del. Строка форматируется не чаще раза в секунду.
+    """
+    global _now_cache
+    second = int(time.time())
+    cached_second, cached_value = _now_cache
+    if cached_second == second:
+        return cached_value
+    value = datetime.fromtimestamp(second).isoformat()
+    _now_cache = (second, value)
+    return value
+
+
+def _apply_pragmas(connection):
+    """
+    Применяет настройки производительности к подключению:
+      - journal_mode=WAL: читатели не блокируют писателя и наоборот (режим сохраняется в файле БД).
+      - synchronous=NORMAL: в режиме WAL безопасно и избавляет от fsync на каждом commit.
+      - busy_timeout: ожидание (мс) освобождения блокировки вместо ошибки "database is locked".
+      - temp_store=MEMORY, cache_size: временные данные в памяти, кэш страниц ~20 МБ.
+      - wal_autocheckpoint: перенос WAL в основной файл каждые 1000 страниц, чтобы журнал не разрастался.
+      - mmap_size: чтение файла БД через отображение в память (до 128 МБ) без копирования страниц.
+    """
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-20000")
+    cursor.execute("PRAGMA wal_autocheckpoint=1000")
+    cursor.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+
+
+# Версия схемы, записываемая в PRAGMA user_version после создания схемы. Если версия в файле БД совпадает,
+# скрипт схемы при запуске не выполняется. При любом изменении SCHEMA_SQL версию нужно увеличить.
+SCHEMA_VERSION = 3
+
+# Схема базы данных: все таблицы и индексы создаются одним скриптом (executescript) в одной транзакции.
+SCHEMA_SQL = """
+-- Таблица houses хранит информацию о домах (групповых чатах):
+--   - house_name: название дома (необязательно)
+--   - chat_id: уникальный идентификатор чата
+--   - house_city, house_address: адресные данные
+--   - date_add, date_del: даты создания и удаления записи.
+CREATE TABLE IF NOT EXISTS houses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    house_name TEXT,
+    chat_id INTEGER UNIQUE,
+    house_city TEXT,
+    house_address TEXT,
+    date_add TEXT,
+    date_del TEXT
+);
+
+-- Таблица users хранит информацию о пользователях:
+--   - tg_id: Telegram ID пользователя.
+--   - name, surname: имя и фамилия.
+--   - house: идентификатор дома, к которому привязан пользователь.
+--   - apartment: номер квартиры.
+--   - phone: номер телефона.
+--   - date_add, date_del: даты регистрации и удаления.
+-- Уникальность определяется сочетанием (tg_id, house) — пользователь может быть зарегистрирован в разных домах.
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tg_id INTEGER,
+    name TEXT,
+    surname TEXT,
+    house INTEGER,
+    apartment TEXT,
+    phone TEXT,
+    date_add TEXT,
+    date_del TEXT,
+    FOREIGN KEY(house) REFERENCES houses(id),
+    UNIQUE(tg_id, house)
+);
+
+-- Таблица cars хранит информацию об автомобилях пользователей:
+--   - user: внешний ключ, ссылающийся на пользователя.
+--   - autonum: номер автомобиля.
+--   - date_add, date_del: даты добавления и удаления записи.
+CREATE TABLE IF NOT EXISTS cars (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user INTEGER,
+    autonum TEXT,
+    date_add TEXT,
+    date_del TEXT,
+    FOREIGN KEY(user) REFERENCES users(id)
+);
+
+-- Таблица user_states хранит состояния диалогов с пользователями (например, ожидание фото),
+-- чтобы они не терялись при перезапуске бота:
+--   - tg_id: Telegram ID пользователя (одно состояние на пользователя).
+--   - state: текущее состояние.
+--   - date_upd: дата последнего изменения состояния.
+CREATE TABLE IF NOT EXISTS user_states (
+    tg_id INTEGER PRIMARY KEY,
+    state TEXT,
+    date_upd TEXT
+);
+
+-- Индексы для частых выборок:
+--   - users.tg_id и users(tg_id, house) уже покрыты индексом ограничения UNIQUE(tg_id, house),
+--     houses.chat_id — индексом UNIQUE(chat_id).
+--   - cars.user: обновление автомобилей пользователя (выход из чата, отказ, подтверждение доступа).
+--   - users.house: соединение users с houses и подсчёт жильцов дома (/check, /checkall).
+--   - Частичный индекс cars(user) по активным записям (date_del IS NULL): закрытие автомобилей пользователя.
+--   - Частичный индекс users(tg_id) по активным записям: проверка оставшихся активных записей пользователя
+--     при выходе из чата (в индекс попадают только активные пользователи).
+--   - Частичный индекс users(house) по активным записям: подсчёт активных жильцов всех домов (/checkall).
+CREATE INDEX IF NOT EXISTS idx_cars_user ON cars(user);
+CREATE INDEX IF NOT EXISTS idx_users_house ON users(house);
+CREATE INDEX IF NOT EXISTS idx_cars_active ON cars(user) WHERE date_del IS NULL;
+CREATE INDEX IF NOT EXISTS idx_users_active ON users(tg_id) WHERE date_del IS NULL;
+CREATE INDEX IF NOT EXISTS idx_users_house_active ON users(house) WHERE date_del IS NULL;
+"""
+
+# Замена пустых строк в date_del на NULL: активной считается только запись с date_del IS NULL,
+# поэтому запросы не проверяют дополнительно date_del = ''.
+NORMALIZE_DATES_SQL = """
+UPDATE houses SET date_del = NULL WHERE trim(date_del) = '';
+UPDATE users SET date_del = NULL WHERE trim(date_del) = '';
+UPDATE cars SET date_del = NULL WHERE trim(date_del) = '';
+"""
+
+
+def init_db(db_file, read_connections):
+    """
+    Открывает подключение для записи, создаёт схему и заполняет пул из read_connections подключений
+    только для чтения. Если файл базы данных отсутствует, SQLite создаст его автоматически.
+    """
+    global DB_FILE, conn, _read_pool
+    DB_FILE = db_file
+    # check_same_thread=False: подключение используется потоками telebot, доступ сериализуется write_lock.
+    # cached_statements: кэш подготовленных запросов подключения (по тексту SQL) больше числа разных запросов бота.
+    conn = sqlite3.connect(db_file, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    _apply_pragmas(conn)
+    # Создание схемы, нормализация дат и запись версии схемы выполняются одним скриптом в одной транзакции
+    # (один commit); для БД с актуальной версией схемы скрипт пропускается.
+    # ANALYZE собирает статистику по индексам для планировщика запросов после изменения схемы.
+    if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        conn.executescript("BEGIN;\n" + SCHEMA_SQL + NORMALIZE_DATES_SQL + "ANALYZE;\n" +
+                           f"PRAGMA user_version = {SCHEMA_VERSION};\nCOMMIT;")
+    with _houses_lock:
+        HOUSES.clear()
+        HOUSES.update(conn.execute("SELECT chat_id, id FROM houses"))
+
+    # Подключения только для чтения открываются после создания схемы, т.к. режим ro не создаёт файл.
+    _read_pool = queue.Queue()
+    ro_uri = f"file:{quote(db_file)}?mode=ro"
+    for _ in range(read_connections):
+        ro_conn = sqlite3.connect(ro_uri, uri=True, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+        ro_conn.execute("PRAGMA busy_timeout=5000")
+        ro_conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        _read_pool.put(ro_conn)
+
+
+def _begin_immediate(cursor):
+    """
+    Начинает транзакцию с немедленным захватом блокировки записи (BEGIN IMMEDIATE).
+    Блокировка берётся до выполнения запросов блока, поэтому при занятой базе попытку можно безопасно
+    повторить: если база остаётся заблокированной, повторяются только попытки начать транзакцию.
+    """
+    for attempt in range(LOCK_RETRIES):
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or attempt == LOCK_RETRIES - 1:
+                raise
+            time.sleep(LOCK_RETRY_DELAY * 2 ** attempt)
+
+
+@contextmanager
+def transaction():
+    """
+    Выдаёт курсор подключения для записи в рамках одной транзакции:
+      - Транзакция начинается с захвата блокировки записи (см. _begin_immediate).
+      - При успешном выходе из блока изменения фиксируются (commit).
+      - При исключении изменения откатываются (rollback), исключение пробрасывается дальше.
+      - Вложенный вызов из того же потока (например, сохранение состояния из on_set словаря user_state
+        внутри блока transaction) выполняется в рамках внешней транзакции, а не ждёт блокировку.
+    """
+    with write_lock:
+        if conn.in_transaction:
+            # Блокировка уже захвачена этим потоком: фиксацию или откат выполнит внешняя транзакция.
+            yield conn.cursor()
+            return
+        cursor = conn.cursor()
+        _begin_immediate(cursor)
+        try:
+            yield cursor
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+@contextmanager
+def read_cursor():
+    """
+    Выдаёт курсор одного из подключений только для чтения и возвращает подключение в пул после использования.
+    """
+    ro_conn = _read_pool.get()
+    try:
+        yield ro_conn.cursor()
+    finally:
+        _read_pool.put(ro_conn)
+
+
+def save_user_state(tg_id, state):
+    """
+    Сохраняет (или заменяет) состояние диалога пользователя.
+    """
+    with transaction() as cursor:
+        cursor.execute("""
+          INSERT INTO user_states (tg_id, state, date_upd) VALUES (?, ?, ?)
+          ON CONFLICT(tg_id) DO UPDATE SET state = excluded.state, date_upd = excluded.date_upd
+        """, (tg_id, state, now_iso()))
+
+
+def delete_user_state(tg_id):
+    """
+    Удаляет сохранённое состояние диалога пользователя.
+    """
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM user_states WHERE tg_id = ?", (tg_id,))
+
+
+def load_user_states(max_age):
+    """
+    Удаляет состояния старше max_age секунд и возвращает оставшиеся в виде списка пар (tg_id, state).
+    """
+    cutoff = (datetime.now() - timedelta(seconds=max_age)).isoformat()
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM user_states WHERE date_upd < ?", (cutoff,))
+        cursor.execute("SELECT tg_id, state FROM user_states")
+        return cursor.fetchall()
+
+
+def get_user_profile(tg_id):
+    """
+    Возвращает (id, name, surname, apartment, phone) первой записи пользователя tg_id или None, если записей нет.
+    Результат кэшируется (см. _user_profile_cache).
+    """
+    try:
+        return _user_profile_cache[tg_id]
+    except KeyError:
+        pass
+    with read_cursor() as cursor:
+        cursor.execute("SELECT id, name, surname, apartment, phone FROM users WHERE tg_id = ? LIMIT 1", (tg_id,))
+        profile = cursor.fetchone()
+    _user_profile_cache[tg_id] = profile
+    return profile
+
+
+def invalidate_user_profile(tg_id):
+    """
+    Удаляет анкетные данные пользователя из кэша (вызывается после изменения записей users).
+    """
+    _user_profile_cache.pop(tg_id, None)
+
+
+def get_house_id(chat_id):
+    """
+    Возвращает id дома для группового чата chat_id или None, если дом не зарегистрирован.
+    Чаты, которых нет в HOUSES, проверяются в базе (запись могла появиться в другом процессе).
+    """
+    house_id = HOUSES.get(chat_id)
+    if house_id is not None:
+        return house_id
+    with read_cursor() as cursor:
+        cursor.execute("SELECT id FROM houses WHERE chat_id = ?", (chat_id,))
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    with _houses_lock:
+        HOUSES[chat_id] = row[0]
+    return row[0]
+
+
+def ensure_house(cursor, chat_id, now):
+    """
+    Возвращает id дома для чата chat_id, создавая запись houses при её отсутствии.
+    Вызывается внутри transaction(); созданная запись попадёт в HOUSES при следующем обращении после commit.
+    """
+    house_id = HOUSES.get(chat_id)
+    if house_id is not None:
+        return house_id
+    cursor.execute("SELECT id FROM houses WHERE chat_id = ?", (chat_id,))
+    row = cursor.fetchone()
+    if row is not None:
+        with _houses_lock:
+            HOUSES[chat_id] = row[0]
+        return row[0]
+    cursor.execute("INSERT INTO houses (chat_id, date_add) VALUES (?, ?)", (chat_id, now))
+    return cursor.lastrowid
@@ -31,13 +31,18 @@
 # -------------------------------
 import telebot               # telebot: для взаимодействия с Telegram Bot API.
 import logging               # logging: для логирования действий и ошибок.
-from datetime import datetime, timedelta  # datetime: для работы с датами и временем.
 from telebot.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
 # telebot.types: предоставляет классы для создания интерактивных клавиатур.
 import os                    # os: для работы с файловой системой и переменными окружения.
+import time                  # time: для времени присоединения участников и срока блокировки.
+from concurrent.futures import ThreadPoolExecutor  # ThreadPoolExecutor: для параллельных запросов к Telegram API.
+from functools import lru_cache  # lru_cache: для кэширования повторно отправляемых клавиатур.
 from dotenv import load_dotenv  # load_dotenv: позволяет загрузить переменные окружения из файла .env.
-import sqlite3               # sqlite3: для работы с SQLite базой данных.
+import database              # database: общее подключение к SQLite базе данных.
+from state_store import PendingUser, TTLDict, UserState  # TTLDict: словарь состояний с ограничением размера и времени жизни.
+from telegram_sender import MAX_CAPTION_LENGTH, TelegramSender, split_messages  # TelegramSender: фоновая отправка уведомлений.
 import registration
+from webhook_server import run_webhook  # run_webhook: приём обновлений через webhook (если задан WEBHOOK_URL).
 
 # -------------------------------
 # Определение путей и загрузка настроек
@@ -51,105 +56,283 @@ DB_FILE = os.path.join(BASE_DIR, "database.db")
 load_dotenv()
 # Получаем API_TOKEN, ADMIN_ID и BOT_NAME из переменных окружения.
 API_TOKEN = os.getenv("API_TOKEN")
-ADMIN_ID = int(os.getenv("ADMIN_ID"))
+# ADMIN_ID один раз преобразуется в int: дальше он сравнивается с числовыми chat_id/user_id без приведения типов.
+# Если переменная не задана, ADMIN_ID = None и ниже выдаётся понятная ошибка.
+ADMIN_ID = int(os.getenv("ADMIN_ID")) if os.getenv("ADMIN_ID") else None
 BOT_NAME = os.getenv("BOT_NAME")
+# Режим webhook включается переменной WEBHOOK_URL (публичный HTTPS-адрес бота, например https://bot.example.com);
+# без неё бот получает обновления через long polling. WEBHOOK_SECRET (обязателен в режиме webhook) передаётся
+# Telegram и проверяется в каждом запросе: без него любой, кто может отправить запрос на адрес бота, мог бы
+# подделать обновления от имени администратора. WEBHOOK_LISTEN/WEBHOOK_PORT — локальный адрес,
+# на который обратный прокси передаёт запросы.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
 
 # -------------------------------
 # Настройка логирования
 # -------------------------------
 # Логирование настроено на вывод времени, уровня и текста сообщения.
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Уровень задаётся переменной окружения LOG_LEVEL (по умолчанию INFO; в рабочем режиме можно указать WARNING).
+# Сообщения передаются логгеру с аргументами (logger.info("... %s", x)), поэтому строка форматируется
+# только если сообщение действительно выводится.
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 # -------------------------------
 # Глобальные словари для отслеживания состояний
 # -------------------------------
-admin_to_user_map = {}  # Предполагаемый маппинг между администратором и пользователями (пока не используется).
-user_state = {}         # Словарь для хранения состояния диалога с каждым пользователем (ключ – tg_id).
-admin_state = {}        # Состояние администратора, например, при запросе нового фото.
+# Словари состояний пользователей ограничены по размеру и времени жизни записи:
+# незавершённые регистрации не накапливаются в памяти бесконечно.
+STATE_MAX_USERS = 10000         # Максимальное число пользователей в словаре состояний.
+STATE_TTL = 24 * 60 * 60        # Время жизни состояния в секундах (сутки).
+
+
+# Состояния, записанные в таблицу user_states: tg_id -> UserState. По нему определяется, есть ли в базе строка,
+# которую нужно удалить, чтобы шаги анкеты не выполняли лишних транзакций.
+_persisted_user_states = TTLDict(maxsize=STATE_MAX_USERS, ttl=STATE_TTL)
+
+
+def _persist_user_state(user_id, state):
+    """
+    Сохраняет состояние пользователя в базе данных, чтобы оно пережило перезапуск бота.
+    Сохраняются только состояния UserState (например, UserState.AWAITING_PHOTO); ответы незавершённой анкеты
+    хранятся только в памяти, т.к. шаги анкеты (register_next_step_handler) после перезапуска всё равно теряются.
+    Запись выполняется только при смене состояния UserState и при переходе к анкете от сохранённого состояния.
+    """
+    if not isinstance(state, UserState):
+        _forget_user_state(user_id)
+        return
+    if _persisted_user_states.get(user_id) is state:
+        return
+    try:
+        database.save_user_state(user_id, state.value)
+        _persisted_user_states[user_id] = state
+    except Exception as e:
+        logger.error("Ошибка сохранения состояния пользователя %s: %s", user_id, e)
+
+
+def _forget_user_state(user_id):
+    """
+    Удаляет сохранённое состояние пользователя из базы данных, если оно было записано.
+    """
+    if _persisted_user_states.pop(user_id, None) is None:
+        return
+    try:
+        database.delete_user_state(user_id)
+    except Exception as e:
+        logger.error("Ошибка удаления состояния пользователя %s: %s", user_id, e)
+
+
+def _restored_user_states():
+    """
+    Возвращает сохранённые в базе состояния пользователей в виде пар (tg_id, UserState).
+    Состояния, которых нет в UserState (например, после переименования), пропускаются и удаляются из базы,
+    чтобы одна такая запись не мешала запуску бота.
+    """
+    states = []
+    for tg_id, state in database.load_user_states(STATE_TTL):
+        try:
+            states.append((tg_id, UserState(state)))
+        except ValueError:
+            logger.warning("Неизвестное состояние '%s' пользователя %s пропущено при загрузке.", state, tg_id)
+            try:
+                database.delete_user_state(tg_id)
+            except Exception as e:
+                logger.error("Ошибка удаления состояния пользователя %s: %s", tg_id, e)
+    return states
+
+
+# Словарь для хранения состояния диалога с каждым пользователем (ключ – tg_id).
+user_state = TTLDict(maxsize=STATE_MAX_USERS, ttl=STATE_TTL,
+                     on_set=_persist_user_state, on_delete=_forget_user_state)
+# Администратор один (ADMIN_ID), поэтому его состояние — одно значение:
+# user_id пользователя, для которого администратор вводит причину запроса нового фото, или None.
+admin_reason_user_id = None
+
+# Обработчики бота выполняются в пуле из BOT_THREADS потоков: пока один обработчик ждёт ответа Telegram
+# или базы данных, остальные обновления обрабатываются параллельно.
+BOT_THREADS = 8
 
 # -------------------------------
 # Инициализация базы данных
 # -------------------------------
-# Подключаемся к базе данных; если файл отсутствует, SQLite создаст его автоматически.
-conn = sqlite3.connect(DB_FILE)
-cursor = conn.cursor()
-
-# Таблица houses хранит информацию о домах (групповых чатах):
-#   - house_name: название дома (необязательно)
-#   - chat_id: уникальный идентификатор чата
-#   - house_city, house_address: адресные данные
-#   - date_add, date_del: даты создания и удаления записи.
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS houses (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        house_name TEXT,
-        chat_id INTEGER UNIQUE,
-        house_city TEXT,
-        house_address TEXT,
-        date_add TEXT,
-        date_del TEXT
-    )
-''')
-
-# Таблица users хранит информацию о пользователях:
-#   - tg_id: Telegram ID пользователя.
-#   - name, surname: имя и фамилия.
-#   - house: идентификатор дома, к которому привязан пользователь.
-#   - apartment: номер квартиры.
-#   - phone: номер телефона.
-#   - date_add, date_del: даты регистрации и удаления.
-# Уникальность определяется сочетанием (tg_id, house) — пользователь может быть зарегистрирован в разных домах.
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        tg_id INTEGER,
-        name TEXT,
-        surname TEXT,
-        house INTEGER,
-        apartment TEXT,
-        phone TEXT,
-        date_add TEXT,
-        date_del TEXT,
-        FOREIGN KEY(house) REFERENCES houses(id),
-        UNIQUE(tg_id, house)
-    )
-''')
-
-# Таблица cars хранит информацию об автомобилях пользователей:
-#   - user: внешний ключ, ссылающийся на пользователя.
-#   - autonum: номер автомобиля.
-#   - date_add, date_del: даты добавления и удаления записи.
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS cars (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user INTEGER,
-        autonum TEXT,
-        date_add TEXT,
-        date_del TEXT,
-        FOREIGN KEY(user) REFERENCES users(id)
-    )
-''')
-conn.commit()
-conn.close()
+# Открываем общее подключение к базе данных и создаём таблицы houses, users и cars (см. модуль database).
+# Если файл отсутствует, SQLite создаст его автоматически.
+# Пул подключений для чтения по одному на поток обработчиков, чтобы чтение не ждало свободного подключения.
+database.init_db(DB_FILE, read_connections=BOT_THREADS)
+# Восстанавливаем сохранённые состояния пользователей (например, ожидание фото) после перезапуска.
+restored_states = _restored_user_states()
+user_state.load(restored_states)
+_persisted_user_states.load(restored_states)
 
 # Проверка наличия обязательных переменных окружения.
 if not API_TOKEN or not ADMIN_ID:
     raise ValueError("API_TOKEN и ADMIN_ID должны быть указаны в .env")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise ValueError("WEBHOOK_SECRET должен быть указан в .env, если задан WEBHOOK_URL")
 
 # -------------------------------
 # Инициализация Telegram-бота
 # -------------------------------
-bot = telebot.TeleBot(API_TOKEN)
+# Доступ к общему подключению на запись сериализуется блокировкой в модуле database.
+bot = telebot.TeleBot(API_TOKEN, threaded=True, num_threads=BOT_THREADS)
+# Идентификатор и username бота не меняются за время работы процесса, поэтому запрашиваем их у Telegram один раз.
+_bot_info = bot.get_me()
+BOT_ID = _bot_info.id
+BOT_USERNAME = _bot_info.username
+# Если BOT_NAME не указан в .env, для ссылки на бота используем его username из Telegram.
+BOT_NAME = BOT_NAME or BOT_USERNAME
 
-# Словарь pending_users хранит данные о новых участниках:
-#   - status: текущий статус регистрации (например, 'awaiting_photo').
-#   - join_time: время присоединения к чату.
-#   - source_chat_id: ID исходного чата, откуда пользователь был добавлен.
-pending_users = {}
+# -------------------------------
+# Неизменяемые клавиатуры
+# -------------------------------
+# Клавиатуры без данных конкретного пользователя создаются один раз и переиспользуются во всех обработчиках.
+def _keyboard(row_width, *buttons):
+    keyboard = InlineKeyboardMarkup(row_width=row_width)
+    keyboard.add(*buttons)
+    return keyboard
+
+# Меню команды /start: регистрация и две заглушки.
+START_KEYBOARD = _keyboard(1,
+    InlineKeyboardButton("Регистрация в чате", callback_data="start_introduction"),
+    InlineKeyboardButton("Полезная информация", callback_data="info_placeholder"),
+    InlineKeyboardButton("Написать администратору", callback_data="admin_placeholder"))
+# Кнопка для начала процесса регистрации (/newuser).
+INTRO_KEYBOARD = _keyboard(1, InlineKeyboardButton("Познакомиться", callback_data="start_introduction"))
+# Ссылка на личный чат с ботом для новых участников группы.
+ACCESS_KEYBOARD = _keyboard(1, InlineKeyboardButton("Получить доступ", url=f"https://t.me/{BOT_NAME}?start=newuser"))
+# Подтверждение проживания или отказ.
+RESIDENCE_KEYBOARD = _keyboard(1,
+    InlineKeyboardButton("Живу тут и готов подтвердить", callback_data="confirm_residence"),
+    InlineKeyboardButton("Не живу тут", callback_data="not_residing"))
+# Предложение вернуться в группу.
+RETURN_KEYBOARD = _keyboard(2,
+    InlineKeyboardButton("Да", callback_data="return_yes"),
+    InlineKeyboardButton("Нет", callback_data="return_no"))
+
+# Пул потоков для независимых запросов к Telegram API внутри одного обработчика:
+# вместо последовательного ожидания каждого HTTPS-ответа запросы выполняются параллельно.
+API_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="telegram-api")
+
+# Очередь информационных уведомлений: обработчики не ждут отправки каждого сообщения,
+# а сообщения для одного чата, поставленные в очередь почти одновременно, уходят одним сообщением.
+sender = TelegramSender(bot)
+
+# Кэш результатов bot.get_chat: chat_id -> объект Chat.
+# Название и username чата меняются редко, а каждый запрос к Telegram — это отдельный HTTPS-запрос.
+# Размер кэша ограничен: при переполнении вытесняются самые старые записи.
+CHAT_CACHE_TTL = 300        # Время жизни записи кэша в секундах.
+CHAT_CACHE_MAX_SIZE = 1000  # Максимальное число записей в кэше.
+_chat_cache = TTLDict(maxsize=CHAT_CACHE_MAX_SIZE, ttl=CHAT_CACHE_TTL)
+
+# Кэш результатов bot.get_chat_member: (chat_id, user_id) -> объект ChatMember.
+# Короткое время жизни покрывает повторные нажатия одной кнопки и несколько уведомлений об одном пользователе.
+MEMBER_CACHE_TTL = 30           # Время жизни записи кэша в секундах.
+MEMBER_CACHE_MAX_SIZE = 10000   # Максимальное число записей в кэше.
+_member_cache = TTLDict(maxsize=MEMBER_CACHE_MAX_SIZE, ttl=MEMBER_CACHE_TTL)
+
+# Словарь pending_users хранит данные о новых участниках: tg_id -> PendingUser
+# (статус регистрации, время присоединения, исходный чат, причина запроса и file_id фото; см. state_store).
+# Данные не сохраняются в базе: source_chat_id при необходимости восстанавливается из таблиц users и houses.
+pending_users = TTLDict(maxsize=STATE_MAX_USERS, ttl=STATE_TTL)
 group_id = None         # Переменная для хранения ID текущей группы (используется в некоторых местах).
 source_chat_id = None   # Переменная для хранения исходного chat_id (используется при регистрации).
 
-registration.init_registration(bot, DB_FILE, pending_users, user_state)
+# ====================================================================
+# Функция get_chat_cached
+# ====================================================================
+def get_chat_cached(chat_id):
+    """
+    Возвращает информацию о чате (результат bot.get_chat):
+      - Если в кэше есть запись моложе CHAT_CACHE_TTL секунд, возвращает её без обращения к Telegram.
+      - Иначе запрашивает чат у Telegram и сохраняет результат в кэш.
+    Исключения bot.get_chat пробрасываются вызывающему коду.
+    """
+    chat = _chat_cache.get(chat_id)
+    if chat is not None:
+        return chat
+    chat = bot.get_chat(chat_id)
+    _chat_cache[chat_id] = chat
+    return chat
+
+# ====================================================================
+# Функция fetch_member_cached
+# ====================================================================
+def fetch_member_cached(chat_id, user_id):
+    """
+    Возвращает информацию об участнике чата (результат bot.get_chat_member), используя кэш
+    на MEMBER_CACHE_TTL секунд. Ошибки запроса логируются, в этом случае возвращается None.
+    """
+    key = (chat_id, user_id)
+    member = _member_cache.get(key)
+    if member is not None:
+        return member
+    try:
+        member = bot.get_chat_member(chat_id, user_id)
+    except Exception as e:
+        logger.error("Ошибка проверки участника %s в чате %s: %s", user_id, chat_id, e)
+        return None
+    _member_cache[key] = member
+    return member
+
+def forget_member(chat_id, user_id):
+    """
+    Удаляет из кэша информацию об участнике чата: вызывается после изменения его статуса
+    (удаление, ограничение, выход), чтобы решения о доступе не принимались по устаревшим данным.
+    """
+    _member_cache.pop((chat_id, user_id), None)
+
+def restrict_member(chat_id, user_id, **permissions):
+    """
+    Ограничивает участника чата (bot.restrict_chat_member) и сбрасывает его запись в кэше участников.
+    Исключения bot.restrict_chat_member пробрасываются вызывающему коду.
+    """
+    try:
+        bot.restrict_chat_member(chat_id, user_id, **permissions)
+    finally:
+        forget_member(chat_id, user_id)
+
+# ====================================================================
+# Функция kick_from_chat
+# ====================================================================
+# Срок бана при удалении из чата: Telegram считает бан короче 30 секунд вечным, поэтому берём с запасом.
+KICK_BAN_SECONDS = 35
+
+def kick_from_chat(chat_id, user_id):
+    """
+    Удаляет пользователя из чата без постоянной блокировки:
+    бан с автоматическим снятием через KICK_BAN_SECONDS заменяет пару kick + unban одним запросом к Telegram.
+    Исключения bot.ban_chat_member пробрасываются вызывающему коду.
+    """
+    try:
+        bot.ban_chat_member(chat_id, user_id, until_date=int(time.time()) + KICK_BAN_SECONDS)
+    finally:
+        forget_member(chat_id, user_id)
+
+# Модуль регистрации удаляет пользователей из чата так же, как остальные обработчики (через kick_from_chat).
+registration.init_registration(bot, pending_users, user_state, kick_from_chat)
+
+# Клавиатура выбора исходного чата пользователя, зарегистрированного в нескольких домах.
+# Клавиатура не изменяется при отправке (сериализуется в JSON), поэтому одинаковые клавиатуры
+# для повторных запросов по тому же пользователю и набору домов берутся из кэша.
+@lru_cache(maxsize=512)
+def _choose_source_keyboard(user_id, rows):
+    return _keyboard(1, *(
+        InlineKeyboardButton(f"{house_name} ({chat})" if house_name else f"Чат {chat}",
+                             callback_data=f"choose_source:{user_id}:{chat}")
+        for chat, house_name in rows))
+
+# Кнопки для администратора под фото пользователя: дать доступ, отклонить, запросить новое фото.
+# Пользователь может присылать фото повторно (по запросу администратора), клавиатура для него берётся из кэша.
+@lru_cache(maxsize=512)
+def _approval_keyboard(user_id):
+    return _keyboard(1,
+        InlineKeyboardButton("Дать доступ", callback_data=f"allow:{user_id}"),
+        InlineKeyboardButton("Отклонить доступ", callback_data=f"deny:{user_id}"),
+        InlineKeyboardButton("Запросить новое фото", callback_data=f"request_photo:{user_id}"))
 
 # ====================================================================
 # Функция get_source_chat_id
@@ -163,38 +346,64 @@ def get_source_chat_id(user_id):
           * Если найдено несколько домов, отправляет админу инлайн-клавиатуру для выбора нужного чата.
           * Если домов нет, возвращает None.
     """
-    if user_id in pending_users and pending_users[user_id].get('source_chat_id'):
-        return pending_users[user_id]['source_chat_id']
-    # Подключаемся к БД с использованием пути DB_FILE
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-      SELECT h.chat_id, h.house_name FROM houses h
-      JOIN users u ON u.house = h.id
-      WHERE u.tg_id = ?
-    """, (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
+    pending = pending_users.get(user_id)
+    if pending is not None and pending.source_chat_id:
+        return pending.source_chat_id
+    # Ищем дома пользователя через подключение только для чтения
+    with database.read_cursor() as cursor:
+        cursor.execute("""
+          SELECT h.chat_id, h.house_name FROM houses h
+          JOIN users u ON u.house = h.id
+          WHERE u.tg_id = ?
+        """, (user_id,))
+        rows = cursor.fetchall()
     if len(rows) == 1:
-         pending_users[user_id] = pending_users.get(user_id, {})
-         pending_users[user_id]['source_chat_id'] = rows[0][0]
+         pending_users.setdefault(user_id, PendingUser()).source_chat_id = rows[0][0]
          return rows[0][0]
     elif len(rows) > 1:
          # Если пользователь зарегистрирован сразу в нескольких домах, просим администратора выбрать нужный чат.
-         keyboard = InlineKeyboardMarkup(row_width=1)
-         for chat, house_name in rows:
-              button_text = f"{house_name} ({chat})" if house_name else f"Чат {chat}"
-              button = InlineKeyboardButton(button_text, callback_data=f"choose_source:{user_id}:{chat}")
-              keyboard.add(button)
-         bot.send_message(ADMIN_ID, f"Выберите чат пользователя с id {user_id}", reply_markup=keyboard)
+         bot.send_message(ADMIN_ID, f"Выберите чат пользователя с id {user_id}",
+                          reply_markup=_choose_source_keyboard(user_id, tuple(rows)))
          return None
     else:
          return None
 
+# ====================================================================
+# Функция callback_user_id
+# ====================================================================
+def callback_user_id(call):
+    """
+    Возвращает user_id из callback_data вида "<действие>:<user_id>" (allow, deny, request_photo).
+    str.partition не создаёт промежуточный список, в отличие от split.
+    """
+    return int(call.data.partition(":")[2])
+
+# ====================================================================
+# Функция mention
+# ====================================================================
+def mention(name):
+    """
+    Возвращает имя для текста сообщения в виде "@имя" или пустую строку, если имя не задано
+    (в базе данных отсутствующее имя могло быть сохранено строкой 'None').
+    """
+    return f"@{name}" if name and name != 'None' else ""
+
+# ====================================================================
+# Функция resolve_source
+# ====================================================================
+def resolve_source(user_id):
+    """
+    Возвращает исходный групповой чат пользователя (см. get_source_chat_id).
+    Если чат определить не удалось, сообщает пользователю, что чат уточняется администраторами, и возвращает None.
+    """
+    source_chat_id = get_source_chat_id(user_id)
+    if source_chat_id is None:
+        sender.enqueue(user_id, "Ожидайте, идет уточнение чата администраторами.")
+    return source_chat_id
+
 # ====================================================================
 # Callback-обработчик выбора исходного чата администратором
 # ====================================================================
-@bot.callback_query_handler(func=lambda call: call.data.startswith("choose_source:"))
 def choose_source_handler(call):
     """
     Обрабатывает выбор чата администратором:
@@ -205,10 +414,8 @@ def choose_source_handler(call):
     parts = call.data.split(":")
     if len(parts) == 3:
          user_id = int(parts[1])
-         chosen_chat_id = parts[2]
-         if user_id not in pending_users:
-              pending_users[user_id] = {}
-         pending_users[user_id]['source_chat_id'] = chosen_chat_id
+         chosen_chat_id = int(parts[2])
+         pending_users.setdefault(user_id, PendingUser()).source_chat_id = chosen_chat_id
          bot.answer_callback_query(call.id, "Чат выбран.")
          bot.send_message(ADMIN_ID, f"Для пользователя {user_id} выбран чат {chosen_chat_id}.")
 
@@ -227,25 +434,18 @@ def start_handler(message):
     """
     if message.chat.type != 'private':
         return
-    user_first_name = f"@{message.from_user.first_name}" if message.from_user.first_name else "сосед"
-    keyboard = InlineKeyboardMarkup(row_width=1)
-    reg_button = InlineKeyboardButton("Регистрация в чате", callback_data="start_introduction")
-    info_button = InlineKeyboardButton("Полезная информация", callback_data="info_placeholder")
-    admin_button = InlineKeyboardButton("Написать администратору", callback_data="admin_placeholder")
-    keyboard.add(reg_button, info_button, admin_button)
+    user_first_name = mention(message.from_user.first_name) or "сосед"
     bot.send_message(message.chat.id,
         f"Привет, {user_first_name}! Я бот чата жильцов из закрытого домового чата. Выбирай задачу, с которой тебе нужно помочь:",
-        reply_markup=keyboard)
+        reply_markup=START_KEYBOARD)
 
 # ====================================================================
 # Callback-обработчик кнопок "Полезная информация" и "Написать администратору" (пока заглушки)
 # ====================================================================
-@bot.callback_query_handler(func=lambda call: call.data == "info_placeholder")
 def info_placeholder_handler(call):
     bot.send_message(call.message.chat.id, "Функция пока не реализована")
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda call: call.data == "admin_placeholder")
 def admin_placeholder_handler(call):
     bot.send_message(call.message.chat.id, "Функция пока не реализована")
     bot.answer_callback_query(call.id)
@@ -254,7 +454,7 @@ def admin_placeholder_handler(call):
 # Обработчик команды /newuser в личном чате
 # ====================================================================
 @bot.message_handler(commands=['newuser'])
-def start_handler(message):
+def newuser_handler(message):
     """
     Обрабатывает команду /newuser:
       - Работает только в приватном (личном) чате.
@@ -262,19 +462,14 @@ def start_handler(message):
     """
     if message.chat.type != 'private':
         return
-    user_first_name = f"@{message.from_user.first_name}" if message.from_user.first_name else "сосед"
-    keyboard = InlineKeyboardMarkup(row_width=1)
-    # Кнопка для начала процесса регистрации
-    intro_button = InlineKeyboardButton("Познакомиться", callback_data="start_introduction")
-    keyboard.add(intro_button)
+    user_first_name = mention(message.from_user.first_name) or "сосед"
     bot.send_message(message.chat.id,
         f"Привет, {user_first_name}! Я бот чата жильцов. Закрытый чат жителей. Для участия нужно познакомиться и пройти идентификацию. Это займёт 2 минуты.",
-        reply_markup=keyboard)
+        reply_markup=INTRO_KEYBOARD)
 
 # ====================================================================
 # Callback-обработчик кнопок "Познакомиться" и "Регистрация в чате"
 # ====================================================================
-@bot.callback_query_handler(func=lambda call: call.data == "start_introduction")
 def start_introduction_handler(call):
     """
     Обрабатывает нажатие кнопки "Познакомиться":
@@ -283,112 +478,85 @@ def start_introduction_handler(call):
       - Если пользователь уже зарегистрирован в данном доме, предлагает варианты (вернуться в группу или уведомление о регистрации).
       - Если пользователь новый или зарегистрирован для другого дома, запускается процесс полной регистрации (опрос).
     """
-    logging.info(f"start_introduction_handler вызван для пользователя: {call.from_user.id} в чате: {call.message.chat.id}")
+    logger.info("start_introduction_handler вызван для пользователя: %s в чате: %s", call.from_user.id, call.message.chat.id)
     user_id = call.from_user.id
-    user_first_name = f"@{call.from_user.first_name}" if call.from_user.first_name else "сосед"
+    user_first_name = mention(call.from_user.first_name) or "сосед"
     # Определяем источник сообщения: если из приватного чата и в pending_users уже есть source_chat_id, то используем его.
-    if call.message.chat.type == "private" and user_id in pending_users and pending_users[user_id].get('source_chat_id'):
-         current_source_chat = pending_users[user_id]['source_chat_id']
-         logging.info(f"Сообщение из приватного чата. Используем сохранённый source_chat: {current_source_chat}")
+    pending = pending_users.get(user_id)
+    if call.message.chat.type == "private" and pending is not None and pending.source_chat_id:
+         current_source_chat = pending.source_chat_id
+         logger.info("Сообщение из приватного чата. Используем сохранённый source_chat: %s", current_source_chat)
     else:
          current_source_chat = call.message.chat.id
-         logging.info(f"Используем текущий chat.id в качестве source_chat: {current_source_chat}")
+         logger.info("Используем текущий chat.id в качестве source_chat: %s", current_source_chat)
 
     # Обновляем или сохраняем source_chat в pending_users
     db_source = get_source_chat_id(user_id)
     if db_source is None or db_source != current_source_chat:
          source_chat = current_source_chat
-         pending_users[user_id] = pending_users.get(user_id, {})
-         pending_users[user_id]['source_chat_id'] = current_source_chat
-         logging.info(f"Устанавливаем source_chat для пользователя {user_id}: {current_source_chat}")
+         pending_users.setdefault(user_id, PendingUser()).source_chat_id = current_source_chat
+         logger.info("Устанавливаем source_chat для пользователя %s: %s", user_id, current_source_chat)
     else:
          source_chat = db_source
-         logging.info(f"Используем существующий source_chat для пользователя {user_id}: {db_source}")
+         logger.info("Используем существующий source_chat для пользователя %s: %s", user_id, db_source)
 
     # Проверяем наличие записи о доме (чат) в таблице houses
-    house_id = None
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM houses WHERE chat_id = ?", (source_chat,))
-    house_row = cursor.fetchone()
-    if house_row:
-        house_id = house_row[0]
-        logging.info(f"Найден дом для чата {source_chat}: house_id = {house_id}")
+    house_id = database.get_house_id(source_chat)
+    if house_id is not None:
+        logger.info("Найден дом для чата %s: house_id = %s", source_chat, house_id)
     else:
-        logging.info(f"Дом для чата {source_chat} не найден")
+        logger.info("Дом для чата %s не найден", source_chat)
 
-    # Проверяем, зарегистрирован ли пользователь для этого дома
-    cursor.execute("SELECT id, name, date_del FROM users WHERE tg_id = ? AND house = ?", (user_id, house_id))
-    user_record = cursor.fetchone()
-    conn.close()
-    logging.info(f"Проверка регистрации пользователя {user_id} для дома {house_id}: user_record = {user_record}")
+    with database.read_cursor() as cursor:
+        # Проверяем, зарегистрирован ли пользователь для этого дома
+        cursor.execute("SELECT id, name, date_del FROM users WHERE tg_id = ? AND house = ?", (user_id, house_id))
+        user_record = cursor.fetchone()
+    logger.info("Проверка регистрации пользователя %s для дома %s: user_record = %s", user_id, house_id, user_record)
 
     if user_record:
         # Если пользователь уже зарегистрирован, проверяем статус подтверждения регистрации
-        if user_record[2] and user_record[2].strip() != "":
-            logging.info(f"Пользователь {user_id} уже зарегистрирован в доме {house_id}. Отправляем предложение вернуться в группу.")
-            keyboard = InlineKeyboardMarkup(row_width=2)
-            yes_button = InlineKeyboardButton("Да", callback_data="return_yes")
-            no_button = InlineKeyboardButton("Нет", callback_data="return_no")
-            keyboard.add(yes_button, no_button)
+        if user_record[2] is not None:
+            logger.info("Пользователь %s уже зарегистрирован в доме %s. Отправляем предложение вернуться в группу.", user_id, house_id)
             bot.send_message(call.message.chat.id,
                              f"А мы вас знаем {user_first_name}! Хотите вернуться в группу?",
-                             reply_markup=keyboard)
+                             reply_markup=RETURN_KEYBOARD)
         else:
-            logging.info(f"Пользователь {user_id} зарегистрирован, но не подтверждён. Отправляем сообщение об этом.")
+            logger.info("Пользователь %s зарегистрирован, но не подтверждён. Отправляем сообщение об этом.", user_id)
             bot.send_message(call.message.chat.id,
-                             f"{('@' + user_record[1]) if user_record[1] and user_record[1] != 'None' else ''}, мы тебя узнали и ты уже зарегистрирован.")
+                             f"{mention(user_record[1])}, мы тебя узнали и ты уже зарегистрирован.")
         bot.answer_callback_query(call.id)
         return
     else:
         # Если пользователь не зарегистрирован для этого дома
-        logging.info(f"Пользователь {user_id} не зарегистрирован для дома {house_id}. Запускаем процесс регистрации.")
+        logger.info("Пользователь %s не зарегистрирован для дома %s. Запускаем процесс регистрации.", user_id, house_id)
         # Если пользователь уже существует в БД (зарегистрирован в другом доме), добавляем новую запись для текущего дома.
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM users WHERE tg_id = ?", (user_id,))
-        existing = cursor.fetchone()
-        conn.close()
+        existing = database.get_user_profile(user_id)
         if existing:
-            logging.info(f"Пользователь {user_id} уже есть в БД, но не зарегистрирован для текущего дома {house_id}.")
-            # Извлекаем уже сохраненные данные для повторного использования.
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute("SELECT name, surname, phone FROM users WHERE tg_id = ? LIMIT 1", (user_id,))
-            data = cursor.fetchone()
-            conn.close()
-            if data:
-                name_existing, surname_existing, phone_existing = data
-            else:
-                name_existing = call.from_user.first_name
-                surname_existing = ""
-                phone_existing = ""
-            now = datetime.now().isoformat()
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            # Ищем существующую запись для данного пользователя с house равным NULL
-            cursor.execute("SELECT id FROM users WHERE tg_id = ? AND house IS NULL", (user_id,))
-            record = cursor.fetchone()
-            if record:
-                # Если запись найдена, обновляем её, сбрасывая date_del
-                cursor.execute("UPDATE users SET name = ?, surname = ?, phone = ?, date_del = NULL WHERE id = ?",
-                               (name_existing, surname_existing, phone_existing, record[0]))
-            else:
-                # Если записи нет, вставляем новую
-                cursor.execute("INSERT INTO users (tg_id, name, surname, phone) VALUES (?, ?, ?, ?)",
-                               (user_id, name_existing, surname_existing, phone_existing))
-            conn.commit()
-            conn.close()
+            logger.info("Пользователь %s уже есть в БД, но не зарегистрирован для текущего дома %s.", user_id, house_id)
+            # Используем уже сохраненные данные повторно.
+            _, name_existing, surname_existing, _, phone_existing = existing
+            with database.transaction() as cursor:
+                # Обновляем существующую запись для данного пользователя с house равным NULL, сбрасывая date_del
+                # (без отдельного SELECT: наличие записи определяется по числу изменённых строк).
+                cursor.execute("""
+                  UPDATE users SET name = ?, surname = ?, phone = ?, date_del = NULL
+                  WHERE id = (SELECT id FROM users WHERE tg_id = ? AND house IS NULL LIMIT 1)
+                """, (name_existing, surname_existing, phone_existing, user_id))
+                if cursor.rowcount == 0:
+                    # Если записи нет, вставляем новую
+                    cursor.execute("INSERT INTO users (tg_id, name, surname, phone) VALUES (?, ?, ?, ?)",
+                                   (user_id, name_existing, surname_existing, phone_existing))
+            database.invalidate_user_profile(user_id)
             # Устанавливаем состояние для запроса номера квартиры в новом доме.
-            user_state[user_id] = "awaiting_apartment_new_house"
+            user_state[user_id] = UserState.AWAITING_APARTMENT_NEW_HOUSE
             bot.send_message(user_id,
                              f"Привет {name_existing}! Ты регистрируешься из нового дома {source_chat}. Введи, пожалуйста, номер квартиры для этого дома.")
-            bot.register_next_step_handler_by_chat_id(user_id, lambda m: registration.process_apartment(m, user_id))
+            bot.register_next_step_handler_by_chat_id(user_id, registration.process_apartment, user_id)
             bot.answer_callback_query(call.id)
             return
         else:
             # Новый пользователь – запускается полный процесс регистрации (опрос).
-            logging.info(f"Пользователь {user_id} новый. Запускаем полный процесс регистрации.")
+            logger.info("Пользователь %s новый. Запускаем полный процесс регистрации.", user_id)
             registration.ask_registration_confirmation(call.message.chat.id, user_id)
             bot.answer_callback_query(call.id)
             return
@@ -405,39 +573,33 @@ def new_member_handler(message):
       - Ограничивает возможность отправки сообщений новыми участниками (исключая самого бота).
       - Отправляет приветственное сообщение с кнопкой для получения доступа, которая ведет к началу регистрации.
     """
-    logging.info("new_member_handler вызван")
+    logger.info("new_member_handler вызван")
     chat_id = message.chat.id
+    # Время вступления определяется один раз для всего события и используется для всех новых участников.
+    join_time = time.time()
     # Проверяем наличие записи о чате в таблице houses
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM houses WHERE chat_id = ?", (chat_id,))
-    house_record = cursor.fetchone()
-    if house_record is None:
+    # (для уже известного чата блокировка записи не берётся).
+    if database.get_house_id(chat_id) is None:
         # Если записи нет, создаём новую с текущей датой.
-        now = datetime.now().isoformat()
-        cursor.execute("INSERT INTO houses (chat_id, date_add) VALUES (?, ?)", (chat_id, now))
-        conn.commit()
-    conn.close()
+        with database.transaction() as cursor:
+            database.ensure_house(cursor, chat_id, database.now_iso())
 
     # Для каждого нового участника выполняем сохранение данных и отправку уведомления.
     for new_member in message.new_chat_members:
-        pending_users[new_member.id] = {
-            'status': 'awaiting_photo',
-            'join_time': datetime.now(),
-            'source_chat_id': chat_id  # Сохраняем ID исходного группового чата.
-        }
+        pending_users[new_member.id] = PendingUser(
+            status='awaiting_photo',
+            join_time=join_time,
+            source_chat_id=chat_id  # Сохраняем ID исходного группового чата.
+        )
         # Если новый участник не является ботом, ограничиваем возможность отправки сообщений.
-        if new_member.id != bot.get_me().id:
+        if new_member.id != BOT_ID:
             try:
-                bot.restrict_chat_member(chat_id, new_member.id, can_send_messages=False)
+                restrict_member(chat_id, new_member.id, can_send_messages=False)
             except telebot.apihelper.ApiTelegramException as e:
-                logging.error(f"Ошибка ограничения для пользователя {new_member.id}: {e}")
-            keyboard = InlineKeyboardMarkup(row_width=1)
-            access_button = InlineKeyboardButton("Получить доступ", url=f"https://t.me/{BOT_NAME}?start=newuser")
-            keyboard.add(access_button)
+                logger.error("Ошибка ограничения для пользователя %s: %s", new_member.id, e)
             bot.send_message(chat_id,
                 f"Добро пожаловать, @{new_member.first_name}! Чтобы получить доступ к чату, пройдите процедуру знакомства и подтверждения. Нажмите кнопку ниже.",
-                reply_markup=keyboard)
+                reply_markup=ACCESS_KEYBOARD)
 
 # ====================================================================
 # Обработчик фотографий для идентификации пользователя
@@ -450,21 +612,18 @@ def photo_handler(message):
       - Если пользователь – бот, отправляет стандартное сообщение.
       - В остальных случаях извлекает данные пользователя из базы и определяет исходный групповой чат.
       - Формирует и отправляет админу сообщение с данными регистрации и фото.
-      - Обновляет состояние пользователя на "photo_sent".
+      - Обновляет состояние пользователя на UserState.PHOTO_SENT.
     """
     user_id = message.from_user.id
-    if user_state.get(user_id) in ["awaiting_photo", "awaiting_new_photo"]:
-        if user_id == bot.get_me().id:
+    state = user_state.get(user_id)
+    if state is UserState.AWAITING_PHOTO or state is UserState.AWAITING_NEW_PHOTO:
+        if user_id == BOT_ID:
             bot.send_message(message.from_user.id, "Фото получено. Ожидайте подтверждения.")
         else:
-            # Извлекаем данные пользователя из БД для формирования сообщения.
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute("SELECT name, surname, apartment, phone FROM users WHERE tg_id = ?", (user_id,))
-            user_info = cursor.fetchone()
-            conn.close()
+            # Извлекаем данные пользователя из БД (через кэш) для формирования сообщения.
+            user_info = database.get_user_profile(user_id)
             if user_info:
-                name, surname, apartment, phone = user_info
+                _, name, surname, apartment, phone = user_info
             else:
                 name = message.from_user.first_name
                 surname = ""
@@ -479,42 +638,44 @@ def photo_handler(message):
 
             # Пытаемся получить информацию о чате (название или username) для включения в сообщение.
             try:
-                group = bot.get_chat(source_chat_id)
+                group = get_chat_cached(source_chat_id)
                 group_title = group.title if group.title else group.username
             except Exception as e:
-                logging.error(f"Ошибка получения информации о чате: {e}")
+                logger.error("Ошибка получения информации о чате: %s", e)
                 group_title = "Неизвестный чат"
 
             # Формируем текстовое сообщение с информацией о регистрации для администратора.
-            registration_info = (
-                f"Новый пользователь {('@' + message.from_user.first_name) if message.from_user.first_name and message.from_user.first_name != 'None' else message.from_user.first_name} (id: {user_id}) "
-                f"подал запрос на регистрацию в чате {('@' + group_title) if group_title and group_title != 'None' else group_title} (id: {source_chat_id}).\n"
-                f"Имя: {name}\n"
-                f"Фамилия: {surname}\n"
-                f"Квартира: {apartment}\n"
-                f"Телефон: {phone}"
-            )
-
-            keyboard = InlineKeyboardMarkup(row_width=1)
-            # Формируем кнопки для администратора: дать доступ, отклонить, запросить новое фото.
-            allow_button = InlineKeyboardButton("Дать доступ", callback_data=f"allow:{user_id}")
-            deny_button = InlineKeyboardButton("Отклонить доступ", callback_data=f"deny:{user_id}")
-            request_photo_button = InlineKeyboardButton("Запросить новое фото", callback_data=f"request_photo:{user_id}")
-            keyboard.add(allow_button, deny_button, request_photo_button)
-
-            # Отправляем собранную информацию и фото админу.
-            bot.send_message(ADMIN_ID, registration_info)
-            bot.send_photo(chat_id=ADMIN_ID, photo=message.photo[-1].file_id, reply_markup=keyboard)
+            registration_info = "\n".join((
+                f"Новый пользователь {mention(message.from_user.first_name)} (id: {user_id}) "
+                f"подал запрос на регистрацию в чате {mention(group_title)} (id: {source_chat_id}).",
+                f"Имя: {name}",
+                f"Фамилия: {surname}",
+                f"Квартира: {apartment}",
+                f"Телефон: {phone}",
+            ))
+
+            # Запоминаем file_id фото: при запросе нового фото администратору повторно отправляется
+            # уже загруженное в Telegram фото (по file_id, без повторной загрузки).
+            photo_file_id = message.photo[-1].file_id
+            pending_users.setdefault(user_id, PendingUser()).photo_file_id = photo_file_id
+
+            # Отправляем собранную информацию и фото админу одним сообщением (информация — подпись к фото);
+            # подпись ограничена MAX_CAPTION_LENGTH символами, более длинный текст отправляется отдельно.
+            if len(registration_info) <= MAX_CAPTION_LENGTH:
+                bot.send_photo(chat_id=ADMIN_ID, photo=photo_file_id, caption=registration_info,
+                               reply_markup=_approval_keyboard(user_id))
+            else:
+                bot.send_message(ADMIN_ID, registration_info)
+                bot.send_photo(chat_id=ADMIN_ID, photo=photo_file_id, reply_markup=_approval_keyboard(user_id))
             # Уведомляем пользователя о получении фото.
             bot.send_message(user_id, "Фото получено. Ожидайте подтверждения.")
 
         # Обновляем состояние пользователя после отправки фото.
-        user_state[user_id] = "photo_sent"
+        user_state[user_id] = UserState.PHOTO_SENT
 
 # ====================================================================
 # Callback-обработчик: разрешение доступа администратором
 # ====================================================================
-@bot.callback_query_handler(func=lambda call: call.data.startswith("allow:"))
 def allow_access(call):
     """
     Обрабатывает нажатие кнопки "Дать доступ":
@@ -523,144 +684,167 @@ def allow_access(call):
       - Обновляет статус пользователя в pending_users и записывает дату регистрации.
       - Отправляет уведомления как пользователю, так и в групповой чат, и информирует администратора.
     """
-    user_id = int(call.data.split(":")[1])
-    source_chat_id = get_source_chat_id(user_id)
+    user_id = callback_user_id(call)
+    source_chat_id = resolve_source(user_id)
     if source_chat_id is None:
-        bot.send_message(user_id, "Ожидайте, идет уточнение чата администраторами.")
         return
-    logging.info(f"Перед обработкой кнопки 'Дать доступ' текущий source_chat_id: {source_chat_id}, пользователь: {user_id}")
-    member = None
+    logger.info("Перед обработкой кнопки 'Дать доступ' текущий source_chat_id: %s, пользователь: %s", source_chat_id, user_id)
+    # Проверка участника, снятие ограничений и получение информации о чате не зависят друг от друга,
+    # поэтому запускаем эти запросы к Telegram параллельно; обновление БД выполняется, пока они в пути.
+    member_future = API_EXECUTOR.submit(fetch_member_cached, source_chat_id, user_id)
+    # Снимаем ограничения, позволяя пользователю отправлять сообщения.
+    restrict_future = API_EXECUTOR.submit(restrict_member, source_chat_id, user_id, can_send_messages=True)
+    source_chat_future = API_EXECUTOR.submit(get_chat_cached, source_chat_id)
+    member = member_future.result()
+    # Участник не найден (ошибка запроса) или уже покинул чат: приветствие в группе не отправляется.
+    in_chat = member is not None and member.status not in ('left', 'kicked')
+    if in_chat:
+        logger.info("Пользователь %s найден в чате %s", user_id, source_chat_id)
+    restricted = True
     try:
-        member = bot.get_chat_member(source_chat_id, user_id)
-        if member.status not in ['left', 'kicked']:
-            logging.info(f"Пользователь {user_id} найден в чате {source_chat_id}")
+        restrict_future.result()
+    except telebot.apihelper.ApiTelegramException as e:
+        logger.error("Ошибка снятия ограничений для %s в чате %s: %s", user_id, source_chat_id, e)
+        restricted = False
+    pending_users.setdefault(user_id, PendingUser(join_time=time.time())).status = 'approved'
+    logger.info("Доступ открыт")
+
+    now = database.now_iso()
+    house_id = database.get_house_id(source_chat_id)
+    # Если дом исходного чата не найден, обновлять нечего: транзакция не открывается.
+    # Ошибка записи логируется: ответ на нажатие кнопки и уведомления отправляются в любом случае.
+    try:
+        if house_id is not None:
+            with database.transaction() as cursor:
+                # Существующий пользователь: обновляем дату регистрации и сбрасываем date_del для данного дома
+                # (без отдельного SELECT: наличие записи определяется по числу изменённых строк).
+                cursor.execute("UPDATE users SET date_add = ?, date_del = NULL WHERE tg_id = ? AND house = ?",
+                               (now, user_id, house_id))
+                if cursor.rowcount == 0:
+                    # Новый пользователь: обновляем запись, где house равен NULL, устанавливая house, дату регистрации и сбрасывая date_del.
+                    cursor.execute(
+                        "UPDATE users SET house = ?, date_add = ?, date_del = NULL WHERE tg_id = ? AND house IS NULL",
+                        (house_id, now, user_id))
+
+                # После обновления записи пользователя сбрасываем date_del и устанавливаем date_add для всех записей автомобилей этого пользователя.
+                cursor.execute("UPDATE cars SET date_del = NULL, date_add = ? WHERE user IN (SELECT id FROM users WHERE tg_id = ?)",
+                               (now, user_id))
     except Exception as e:
-        logging.error(f"Ошибка проверки участника {user_id} в чате {source_chat_id}: {e}")
+        logger.error("Ошибка обновления записи для %s при предоставлении доступа: %s", user_id, e)
+
+    # Информацию о чате запрашиваем один раз (через кэш) и используем повторно.
+    # Если получить её не удалось, пользователь получает уведомление без username чата.
     try:
-        # Снимаем ограничения, позволяя пользователю отправлять сообщения.
-        bot.restrict_chat_member(source_chat_id, user_id, can_send_messages=True)
+        chat_username = source_chat_future.result().username
     except telebot.apihelper.ApiTelegramException as e:
-        logging.error(f"Ошибка снятия ограничений для {user_id} в чате {source_chat_id}: {e}")
-    if user_id not in pending_users:
-        pending_users[user_id] = {'status': 'awaiting_photo', 'join_time': datetime.now()}
-    pending_users[user_id]['status'] = 'approved'
-    logging.info("Доступ открыт")
-
-    now = datetime.now().isoformat()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM houses WHERE chat_id = ?", (source_chat_id,))
-    house_row = cursor.fetchone()
-    if house_row:
-        house_id = house_row[0]
-        # Сначала пытаемся найти запись пользователя для данного дома (существующего пользователя)
-        cursor.execute("SELECT id FROM users WHERE tg_id = ? AND house = ?", (user_id, house_id))
-        record = cursor.fetchone()
-        if record:
-            # Существующий пользователь: обновляем дату регистрации и сбрасываем date_del для данного дома.
-            cursor.execute("UPDATE users SET date_add = ?, date_del = NULL WHERE tg_id = ? AND house = ?",
-                           (now, user_id, house_id))
-        else:
-            # Новый пользователь: обновляем запись, где house равен NULL, устанавливая house, дату регистрации и сбрасывая date_del.
-            cursor.execute(
-                "UPDATE users SET house = ?, date_add = ?, date_del = NULL WHERE tg_id = ? AND house IS NULL",
-                (house_id, now, user_id))
-        conn.commit()
-
-        # После обновления записи пользователя сбрасываем date_del и устанавливаем date_add для всех записей автомобилей этого пользователя.
-        cursor.execute("UPDATE cars SET date_del = NULL, date_add = ? WHERE user IN (SELECT id FROM users WHERE tg_id = ?)",
-                       (now, user_id))
-        conn.commit()
-    conn.close()
-
-    bot.send_message(user_id, f"Доступ разрешён и вы можете пользоваться чатом жильцов" +
-                     (f" (@{bot.get_chat(source_chat_id).username})" if bot.get_chat(source_chat_id).username else "") + ".")
-    bot.send_message(source_chat_id, f"Приветствуем пользователя {('@' + member.user.first_name) if member.user.first_name else member.user.first_name}" +
-                     (f" (@{member.user.username})" if member.user.username else ". Он получил доступ к чату."))
+        logger.error("Ошибка получения информации о чате %s: %s", source_chat_id, e)
+        chat_username = None
+    sender.enqueue(user_id, f"Доступ разрешён и вы можете пользоваться чатом жильцов" +
+                   (f" (@{chat_username})" if chat_username else "") + ".")
     bot.answer_callback_query(call.id, "Доступ предоставлен.")
-    bot.send_message(ADMIN_ID, f"Доступ пользователю {('@' + member.user.first_name) if member.user.first_name else member.user.first_name} предоставлен.")
+    if not restricted:
+        sender.enqueue(ADMIN_ID, f"Не удалось снять ограничения для пользователя {user_id} в чате {source_chat_id}: "
+                                 f"проверьте права бота и снимите ограничения вручную.")
+    if not in_chat:
+        sender.enqueue(ADMIN_ID, f"Доступ пользователю {user_id} предоставлен, но пользователь вне чата ({source_chat_id}).")
+        return
+    sender.enqueue(source_chat_id, f"Приветствуем пользователя {mention(member.user.first_name)}" +
+                   (f" (@{member.user.username})" if member.user.username else ". Он получил доступ к чату."))
+    sender.enqueue(ADMIN_ID, f"Доступ пользователю {mention(member.user.first_name)} предоставлен.")
 
 # ====================================================================
 # Callback-обработчик: отклонение доступа администратором
 # ====================================================================
-@bot.callback_query_handler(func=lambda call: call.data.startswith("deny:"))
 def deny_access(call):
     """
     Обрабатывает нажатие кнопки "Отклонить доступ":
       - Обновляет запись пользователя, устанавливая дату удаления (date_del).
-      - Пытается удалить пользователя из группового чата (kick + unban).
+      - Пытается удалить пользователя из группового чата (временный бан, см. kick_from_chat).
       - Уведомляет пользователя и групповой чат об отклонении, а также информирует администратора.
     """
-    user_id = int(call.data.split(":")[1])
-    source_chat_id = get_source_chat_id(user_id)
+    user_id = callback_user_id(call)
+    source_chat_id = resolve_source(user_id)
     if source_chat_id is None:
-        bot.send_message(user_id, "Ожидайте, идет уточнение чата администраторами.")
         return
-    now = datetime.now().isoformat()
+    # Получение информации об участнике и удаление из чата не зависят друг от друга и от обновления БД,
+    # поэтому запросы к Telegram выполняются параллельно, пока обновляется запись пользователя.
+    # (Для текста уведомлений нужны только имя и username участника, они не меняются при удалении.)
+    member_future = API_EXECUTOR.submit(fetch_member_cached, source_chat_id, user_id)
+    kick_future = API_EXECUTOR.submit(kick_from_chat, source_chat_id, user_id)
+    now = database.now_iso()
+    # Идентификатор дома исходного чата пользователя берётся из кэша до открытия транзакции,
+    # чтобы не удерживать блокировку записи на время поиска.
+    house_id = database.get_house_id(source_chat_id)
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        # Получаем идентификатор дома (house_id) для текущего чата
-        cursor.execute("SELECT id FROM houses WHERE chat_id = ?", (call.message.chat.id,))
-        house_row = cursor.fetchone()
-        if house_row:
-            house_id = house_row[0]
+        if house_id is not None:
+            with database.transaction() as cursor:
+                # Обновляем запись для пользователя, учитывая как tg_id, так и house
+                cursor.execute("UPDATE users SET date_del = ? WHERE tg_id = ? AND house = ?", (now, user_id, house_id))
         else:
-            house_id = None
-
-        # Обновляем запись для пользователя, учитывая как tg_id, так и house
-        cursor.execute("UPDATE users SET date_del = ? WHERE tg_id = ? AND house = ?", (now, user_id, house_id))
-        conn.commit()
-        conn.close()
+            logger.warning("Для чата %s не найден дом (house_id = None)", source_chat_id)
     except Exception as e:
-        logging.error(f"Ошибка обновления записи для {user_id} при отклонении: {e}")
-    member = None
+        logger.error("Ошибка обновления записи для %s при отклонении: %s", user_id, e)
+    member = member_future.result()
     try:
-        member = bot.get_chat_member(source_chat_id, user_id)
-    except Exception as e:
-        logging.error(f"Ошибка проверки участника {user_id} в чате {source_chat_id}: {e}")
-    try:
-        # Удаляем пользователя из группового чата.
-        bot.kick_chat_member(source_chat_id, user_id)
-        bot.unban_chat_member(source_chat_id, user_id)
+        # Дожидаемся удаления пользователя из группового чата.
+        kick_future.result()
     except telebot.apihelper.ApiTelegramException as e:
-        logging.error(f"Ошибка удаления {user_id} из чата {source_chat_id}: {e}")
-    bot.send_message(user_id, "Ваш запрос отклонён. Фото не соответствует требованиям.")
+        logger.error("Ошибка удаления %s из чата %s: %s", user_id, source_chat_id, e)
+    # Запрос участника выполнялся параллельно с удалением и мог сохранить в кэш статус до удаления.
+    forget_member(source_chat_id, user_id)
+    sender.enqueue(user_id, "Ваш запрос отклонён. Фото не соответствует требованиям.")
     if member is not None:
         group_msg = f"Пользователю {member.user.first_name}" + (f" ({member.user.username})" if member.user.username else " доступ не предоставлен, и он удалён.")
     else:
         group_msg = "Пользователь не найден, уведомление не отправлено."
-    bot.send_message(source_chat_id, group_msg)
+    sender.enqueue(source_chat_id, group_msg)
     bot.answer_callback_query(call.id, "Доступ отклонён!")
     admin_msg = f"Доступ пользователю {member.user.first_name if member is not None else user_id} отклонён и он удалён из чата ({source_chat_id})."
-    bot.send_message(ADMIN_ID, admin_msg)
+    sender.enqueue(ADMIN_ID, admin_msg)
 
 # ====================================================================
 # Callback-обработчик: запрос нового фото (администратор)
 # ====================================================================
-@bot.callback_query_handler(func=lambda call: call.data.startswith("request_photo:"))
 def request_photo(call):
     """
     Обрабатывает запрос администратора на получение нового фото:
       - Извлекает user_id из callback_data.
       - Обновляет состояние администратора (ожидание ввода причины).
-      - Отправляет админу сообщение с просьбой указать причину запроса.
+      - Отправляет админу сообщение с просьбой указать причину запроса
+        (вместе с ранее присланным фото пользователя, если оно сохранено).
     """
-    user_id = int(call.data.split(":")[1])
-    source_chat_id = get_source_chat_id(user_id)
+    global admin_reason_user_id
+    user_id = callback_user_id(call)
+    source_chat_id = resolve_source(user_id)
     if source_chat_id is None:
-        bot.send_message(user_id, "Ожидайте, идет уточнение чата администраторами.")
         return
-    logging.info(f"Запрос нового фото, source_chat_id: {source_chat_id}, пользователь: {user_id}")
-    admin_state[ADMIN_ID] = {"user_id": user_id, "awaiting_reason": True}
+    logger.info("Запрос нового фото, source_chat_id: %s, пользователь: %s", source_chat_id, user_id)
+    admin_reason_user_id = user_id
     request_reason = f"Укажите причину запроса нового фото для пользователя {user_id}."
-    bot.send_message(ADMIN_ID, request_reason)
+    pending = pending_users.get(user_id)
+    photo_file_id = pending.photo_file_id if pending is not None else None
+    if photo_file_id:
+        try:
+            bot.send_photo(ADMIN_ID, photo_file_id, caption=request_reason)
+        except telebot.apihelper.ApiTelegramException as e:
+            logger.error("Ошибка повторной отправки фото пользователя %s: %s", user_id, e)
+            sender.enqueue(ADMIN_ID, request_reason)
+    else:
+        sender.enqueue(ADMIN_ID, request_reason)
     bot.answer_callback_query(call.id, "Введите причину запроса нового фото.")
 
 # ====================================================================
 # Обработчик сообщений от администратора (ввод причины запроса нового фото)
 # ====================================================================
-@bot.message_handler(func=lambda message: message.chat.id == ADMIN_ID and not (message.text and message.text.startswith("/")))
+def _is_admin_reason(message):
+    """
+    Фильтр save_reason: сообщение администратора (не команда), пока он вводит причину запроса нового фото.
+    Сначала проверяется admin_reason_user_id — вне режима ввода причины остальные проверки не выполняются.
+    """
+    return (admin_reason_user_id is not None and message.chat.id == ADMIN_ID
+            and not (message.text or "").startswith("/"))
+
+@bot.message_handler(func=_is_admin_reason)
 def save_reason(message):
     """
     Сохраняет причину, введённую администратором для запроса нового фото:
@@ -669,36 +853,27 @@ def save_reason(message):
       - Отправляет уведомление пользователю с просьбой прислать новое фото.
       - Сбрасывает состояние администратора.
     """
-    global admin_state
-    if ADMIN_ID not in admin_state or not admin_state[ADMIN_ID].get("awaiting_reason"):
-        return
-    user_id = admin_state[ADMIN_ID].get("user_id")
+    global admin_reason_user_id
+    user_id = admin_reason_user_id
     if user_id is None:
-        bot.send_message(ADMIN_ID, "Не найден user_id для ADMIN_ID.")
         return
-    if user_id not in pending_users:
-        pending_users[user_id] = {}
-    pending_users[user_id]['reason'] = message.text
-    bot.send_message(ADMIN_ID, "Причина сохранена.")
-    reason = pending_users[user_id].get('reason', "причина не указана")
+    pending_users.setdefault(user_id, PendingUser()).reason = message.text
+    sender.enqueue(ADMIN_ID, "Причина сохранена.")
+    reason = message.text or "причина не указана"
     user_msg = (f"Администратор запросил новое фото по причине: {reason}\n"
                 f"Пожалуйста, отправьте новое фото для подтверждения доступа.")
-    bot.send_message(user_id, user_msg)
-    user_state[user_id] = "awaiting_new_photo"
+    sender.enqueue(user_id, user_msg)
+    user_state[user_id] = UserState.AWAITING_NEW_PHOTO
     src_chat = get_source_chat_id(user_id)
     if src_chat is not None:
-        try:
-            member = bot.get_chat_member(src_chat, user_id)
-            user_first_name = member.user.first_name if member.user.first_name else str(user_id)
-        except Exception as e:
-            logging.error(f"Ошибка получения информации для {user_id}: {e}")
-            user_first_name = str(user_id)
+        member = fetch_member_cached(src_chat, user_id)
+        user_first_name = member.user.first_name if member is not None and member.user.first_name else str(user_id)
         group_msg = (f"@{user_first_name}, администратор запросил новое фото. Проверьте личные сообщения.")
-        bot.send_message(src_chat, group_msg)
+        sender.enqueue(src_chat, group_msg)
     else:
-        logging.error("src_chat не определён, уведомление не отправлено.")
+        logger.error("src_chat не определён, уведомление не отправлено.")
     # Сбрасываем состояние администратора
-    admin_state.pop(ADMIN_ID, None)
+    admin_reason_user_id = None
 
 
 # ====================================================================
@@ -714,52 +889,41 @@ def left_member_handler(message):
     """
     left_user = message.left_chat_member
     user_id = left_user.id
-    now = datetime.now().isoformat()
-    logging.info(f"Обработка выхода пользователя {user_id} из чата {message.chat.id} в {now}")
+    forget_member(message.chat.id, user_id)
+    now = database.now_iso()
+    logger.info("Обработка выхода пользователя %s из чата %s в %s", user_id, message.chat.id, now)
+    # Получаем house_id для текущего чата до открытия транзакции
+    house_id = database.get_house_id(message.chat.id)
+    if house_id is not None:
+        logger.info("Для пользователя %s найден дом: house_id = %s в чате %s", user_id, house_id, message.chat.id)
+    else:
+        logger.warning("Для чата %s не найден дом (house_id = None)", message.chat.id)
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        # Получаем house_id для текущего чата
-        cursor.execute("SELECT id FROM houses WHERE chat_id = ?", (message.chat.id,))
-        house_row = cursor.fetchone()
-        if house_row:
-            house_id = house_row[0]
-            logging.info(f"Для пользователя {user_id} найден дом: house_id = {house_id} в чате {message.chat.id}")
-        else:
-            house_id = None
-            logging.warning(f"Для чата {message.chat.id} не найден дом (house_id = None)")
+        with database.transaction() as cursor:
+            # Обновляем запись для данного чата (только для этого дома)
+            if house_id is not None:
+                cursor.execute("UPDATE users SET date_del = ? WHERE tg_id = ? AND house = ?", (now, user_id, house_id))
+                logger.info("Обновлена дата удаления для пользователя %s с house_id = %s", user_id, house_id)
+            else:
+                # Если дом не найден, можно обновить все записи для tg_id (на всякий случай)
+                cursor.execute("UPDATE users SET date_del = ? WHERE tg_id = ?", (now, user_id))
+                logger.info("Обновлена дата удаления для пользователя %s для всех записей (house_id не найден)", user_id)
 
-        # Обновляем запись для данного чата (только для этого дома)
-        if house_id is not None:
-            cursor.execute("UPDATE users SET date_del = ? WHERE tg_id = ? AND house = ?", (now, user_id, house_id))
-            logging.info(f"Обновлена дата удаления для пользователя {user_id} с house_id = {house_id}")
-        else:
-            # Если дом не найден, можно обновить все записи для tg_id (на всякий случай)
-            cursor.execute("UPDATE users SET date_del = ? WHERE tg_id = ?", (now, user_id))
-            logging.info(f"Обновлена дата удаления для пользователя {user_id} для всех записей (house_id не найден)")
-
-        # Проверяем наличие активных записей (где date_del пустой) для этого пользователя
-        cursor.execute("SELECT COUNT(*) FROM users WHERE tg_id = ? AND (date_del IS NULL OR date_del = '')", (user_id,))
-        active_count = cursor.fetchone()[0]
-        logging.info(f"Для пользователя {user_id} осталось {active_count} активных записей в таблице users")
-        if active_count == 0:
-            # Обновляем поле date_del для всех автомобилей данного пользователя
-            # Здесь используется вложенный запрос, который выбирает все id записей пользователя из таблицы users,
-            # что позволяет обновить все авто, связанные с этим пользователем.
-            cursor.execute("UPDATE cars SET date_del = ? WHERE user IN (SELECT id FROM users WHERE tg_id = ?)",
-                           (now, user_id))
-            logging.info(f"Обновлена дата удаления для всех автомобилей пользователя {user_id}")
-        conn.commit()
+            # Если у пользователя не осталось активных записей (где date_del равен NULL), закрываем все его
+            # активные автомобили. Проверка выполняется в том же запросе (NOT EXISTS), без отдельного подсчёта:
+            # вложенный запрос выбирает все id записей пользователя из таблицы users.
+            cursor.execute("""
+              UPDATE cars SET date_del = ?
+              WHERE user IN (SELECT id FROM users WHERE tg_id = ?) AND date_del IS NULL
+                AND NOT EXISTS (SELECT 1 FROM users WHERE tg_id = ? AND date_del IS NULL)
+            """, (now, user_id, user_id))
+            if cursor.rowcount:
+                logger.info("Обновлена дата удаления для %s автомобилей пользователя %s", cursor.rowcount, user_id)
     except Exception as e:
-        logging.error(f"Ошибка при обработке выхода пользователя {user_id}: {e}")
-    finally:
-        try:
-            conn.close()
-        except Exception as e:
-            logging.error(f"Ошибка закрытия БД для {user_id}: {e}")
+        logger.error("Ошибка при обработке выхода пользователя %s: %s", user_id, e)
     if user_id in pending_users:
         del pending_users[user_id]
-        logging.info(f"Пользователь {user_id} удалён из pending_users")
+        logger.info("Пользователь %s удалён из pending_users", user_id)
 
 
 
@@ -768,7 +932,6 @@ def left_member_handler(message):
 # ====================================================================
 # Callback-обработчик идентификации (подтверждение проживания)
 # ====================================================================
-@bot.callback_query_handler(func=lambda call: call.data == 'identification')
 def identification_handler(call):
     """
     Обрабатывает запрос идентификации пользователя:
@@ -777,32 +940,19 @@ def identification_handler(call):
       - Отправляет пользователю сообщение с кнопками для подтверждения проживания или отказа.
     """
     if call.message.chat is None:
-        logging.error("call.message.chat is None, невозможно обработать идентификацию.")
+        logger.error("call.message.chat is None, невозможно обработать идентификацию.")
         return
     user_id = call.from_user.id
-    source_chat_id = get_source_chat_id(user_id)
+    source_chat_id = resolve_source(user_id)
     if source_chat_id is None:
-        bot.send_message(user_id, "Ожидайте, идет уточнение чата администраторами.")
         return
-    logging.info(f"Идентификация для чата {source_chat_id} (ID: {call.message.chat.id})")
-    keyboard = InlineKeyboardMarkup(row_width=1)
-    # Формируем две кнопки: подтверждение проживания и отказ.
-    confirm_button = InlineKeyboardButton("Живу тут и готов подтвердить", callback_data="confirm_residence")
-    not_residing_button = InlineKeyboardButton("Не живу тут", callback_data="not_residing")
-    keyboard.add(confirm_button, not_residing_button)
-    bot.send_message(call.message.chat.id, "Пожалуйста подтвердите ваше проживание:", reply_markup=keyboard)
-    # Запрос к таблице groups (хотя данные из неё не используются) для логирования.
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM groups")
-    group_ids = cursor.fetchall()
-    logging.info(f"Group IDs: {group_ids}")
-    conn.close()
+    logger.info("Идентификация для чата %s (ID: %s)", source_chat_id, call.message.chat.id)
+    # Две кнопки: подтверждение проживания и отказ.
+    bot.send_message(call.message.chat.id, "Пожалуйста подтвердите ваше проживание:", reply_markup=RESIDENCE_KEYBOARD)
 
 # ====================================================================
 # Callback-обработчик для пользователей, сообщающих, что не являются жильцами
 # ====================================================================
-@bot.callback_query_handler(func=lambda call: call.data == "not_residing")
 def not_residing_handler(call):
     """
     Обрабатывает выбор пользователя, который сообщает, что он не является жильцом:
@@ -813,28 +963,22 @@ def not_residing_handler(call):
     user_id = call.from_user.id
     bot.send_message(call.message.chat.id, "Чат предназначен только для жильцов.")
     source_id = get_source_chat_id(user_id)
-    now = datetime.now().isoformat()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET date_del = ? WHERE tg_id = ?", (now, user_id))
-    cursor.execute("SELECT id FROM users WHERE tg_id = ?", (user_id,))
-    user_record = cursor.fetchone()
-    if user_record:
-        cursor.execute("UPDATE cars SET date_del = ? WHERE user = ? AND (date_del IS NULL OR date_del = '')", (now, user_record[0]))
-    conn.commit()
-    conn.close()
+    now = database.now_iso()
+    with database.transaction() as cursor:
+        cursor.execute("UPDATE users SET date_del = ? WHERE tg_id = ?", (now, user_id))
+        # Закрываем активные автомобили пользователя одним запросом (id записей выбираются вложенным запросом).
+        cursor.execute("UPDATE cars SET date_del = ? WHERE user IN (SELECT id FROM users WHERE tg_id = ?) AND date_del IS NULL",
+                       (now, user_id))
     if source_id:
         try:
-            bot.kick_chat_member(source_id, user_id)
-            bot.unban_chat_member(source_id, user_id)
+            kick_from_chat(source_id, user_id)
         except telebot.apihelper.ApiTelegramException as e:
-            logging.error(f"Ошибка удаления {user_id} из чата {source_id}: {e}")
+            logger.error("Ошибка удаления %s из чата %s: %s", user_id, source_id, e)
     bot.answer_callback_query(call.id)
 
 # ====================================================================
 # Callback-обработчик для выбора опции "Да" при возвращении в группу
 # ====================================================================
-@bot.callback_query_handler(func=lambda call: call.data == "return_yes")
 def return_yes_handler(call):
     """
     Обрабатывает выбор пользователя, который хочет вернуться в группу:
@@ -849,13 +993,12 @@ def return_yes_handler(call):
     # conn.commit()
     # conn.close()
     bot.send_message(call.message.chat.id, "Отлично! Пожалуйста отправьте АКТУАЛЬНУЮ фотографию дворовой территории из окна Вашей квартиры.")
-    user_state[user_id] = "awaiting_photo"
+    user_state[user_id] = UserState.AWAITING_PHOTO
     bot.answer_callback_query(call.id)
 
 # ====================================================================
 # Callback-обработчик для выбора опции "Нет" при возвращении в группу
 # ====================================================================
-@bot.callback_query_handler(func=lambda call: call.data == "return_no")
 def return_no_handler(call):
     """
     Обрабатывает выбор пользователя, который отказывается возвращаться в группу.
@@ -867,7 +1010,6 @@ def return_no_handler(call):
 # ====================================================================
 # Callback-обработчик подтверждения проживания
 # ====================================================================
-@bot.callback_query_handler(func=lambda call: call.data == "confirm_residence")
 def confirm_residence_handler(call):
     """
     Обрабатывает подтверждение проживания пользователя:
@@ -877,33 +1019,27 @@ def confirm_residence_handler(call):
     """
     user_id = call.from_user.id
     source_chat = get_source_chat_id(user_id)
-    house_id = None
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    # Запись пользователя для дома исходного чата получаем одним запросом с соединением users и houses.
+    # Без исходного чата запись не может быть найдена (house = NULL не совпадает ни с одной строкой).
+    user_record = None
     if source_chat:
-         cursor.execute("SELECT id FROM houses WHERE chat_id = ?", (source_chat,))
-         house_row = cursor.fetchone()
-         if house_row:
-              house_id = house_row[0]
-    cursor.execute("SELECT id, name, date_del FROM users WHERE tg_id = ? AND house = ?", (user_id, house_id))
-    user_record = cursor.fetchone()
+        with database.read_cursor() as cursor:
+            cursor.execute("""
+              SELECT u.id, u.name, u.date_del FROM users u
+              JOIN houses h ON u.house = h.id
+              WHERE u.tg_id = ? AND h.chat_id = ?
+            """, (user_id, source_chat))
+            user_record = cursor.fetchone()
     if user_record:
-        if not user_record[2] or user_record[2].strip() == "":
+        if user_record[2] is None:
             bot.send_message(call.message.chat.id, f"{user_record[1]}, мы тебя узнали и ты уже зарегистрирован.")
-            conn.close()
             bot.answer_callback_query(call.id)
             return
         else:
-            keyboard = InlineKeyboardMarkup(row_width=2)
-            yes_button = InlineKeyboardButton("Да", callback_data="return_yes")
-            no_button = InlineKeyboardButton("Нет", callback_data="return_no")
-            keyboard.add(yes_button, no_button)
-            bot.send_message(call.message.chat.id, f"Привет {user_record[1]}! Хотите вернуться в группу?", reply_markup=keyboard)
-            conn.close()
+            bot.send_message(call.message.chat.id, f"Привет {user_record[1]}! Хотите вернуться в группу?", reply_markup=RETURN_KEYBOARD)
             bot.answer_callback_query(call.id)
             return
     else:
-         conn.close()
          bot.send_message(call.message.chat.id, "Ответьте на несколько вопросов, пожалуйста. Данные на серверах хранятся в зашифрованном виде.")
          registration.ask_name(call.message.chat.id, user_id)
          bot.answer_callback_query(call.id)
@@ -912,34 +1048,40 @@ def confirm_residence_handler(call):
 # ====================================================================
 # Обработчик команды /db для администратора (вывод содержимого таблиц)
 # ====================================================================
+# Таблицы и столбцы, выводимые командой /db (в порядке вывода).
+DB_DUMP_TABLES = (
+    ("houses", ("id", "house_name", "chat_id", "house_city", "house_address", "date_add", "date_del")),
+    ("users", ("id", "tg_id", "name", "surname", "house", "apartment", "phone", "date_add", "date_del")),
+    ("cars", ("id", "user", "autonum", "date_add", "date_del")),
+)
+# Тексты запросов строятся один раз при загрузке только из констант выше: во время обработки команд
+# SQL не собирается из строк, а все данные пользователей передаются только через параметры "?".
+DB_DUMP_QUERIES = tuple(
+    (title, columns, f"SELECT {', '.join(columns)} FROM {title}") for title, columns in DB_DUMP_TABLES
+)
+
 @bot.message_handler(commands=['db'])
 def db_handler(message):
     """
     Выводит содержимое таблиц houses, users и cars для администратора.
     Ограничивает доступ к этой команде, если пользователь не является администратором.
     """
-    if message.from_user.id != int(ADMIN_ID):
+    if message.from_user.id != ADMIN_ID:
         bot.send_message(message.chat.id, "Нет доступа")
         return
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    output = "Таблица houses\n id | house_name | chat_id | house_city | house_address | date_add | date_del \n"
-    cursor.execute("SELECT * FROM houses")
-    for row in cursor.fetchall():
-        output += " | ".join(map(str, row)) + "\n"
-    output += "\nТаблица users\n id | tg_id | name | surname | house | apartment | phone | date_add | date_del \n"
-    cursor.execute("SELECT * FROM users")
-    for row in cursor.fetchall():
-        output += " | ".join(map(str, row)) + "\n"
-    output += "\nТаблица cars\n id | user | autonum | date_add | date_del \n"
-    cursor.execute("SELECT * FROM cars")
-    for row in cursor.fetchall():
-        output += " | ".join(map(str, row)) + "\n"
-    conn.close()
-    max_length = 4096
-    # Если вывод слишком длинный, отправляем его порциями.
-    for i in range(0, len(output), max_length):
-        bot.send_message(message.chat.id, output[i:i+max_length])
+    # Строки вывода собираются в список и объединяются один раз (без повторной конкатенации строк).
+    lines = []
+    with database.read_cursor() as cursor:
+        for title, columns, query in DB_DUMP_QUERIES:
+            if lines:
+                lines.append("")
+            lines.append(f"Таблица {title}")
+            lines.append(" " + " | ".join(columns) + " ")
+            cursor.execute(query)
+            lines.extend(" | ".join(map(str, row)) for row in cursor)
+    # Если вывод длиннее MAX_MESSAGE_LENGTH, отправляем его порциями, не разрывая строки таблиц.
+    for chunk in split_messages(lines):
+        bot.send_message(message.chat.id, chunk)
 
 # ====================================================================
 # Обработчик команды /check для администратора (проверка регистрации в указанном чате)
@@ -954,27 +1096,27 @@ def check_handler(message):
       - Из таблицы users извлекает активных пользователей (без даты удаления).
       - Отправляет администратору список зарегистрированных пользователей.
     """
-    if message.from_user.id != int(ADMIN_ID):
+    if message.from_user.id != ADMIN_ID:
         bot.send_message(message.chat.id, "Нет доступа.")
         return
     parts = message.text.split()
     if len(parts) < 2:
         bot.send_message(message.chat.id, "Укажите ID группы, например: /check -123456789")
         return
-    group_id_check = parts[1]
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM houses WHERE chat_id = ?", (group_id_check,))
-        house = cursor.fetchone()
-        if not house:
+        group_id_check = int(parts[1])
+    except ValueError:
+        bot.send_message(message.chat.id, "ID группы должен быть числом, например: /check -123456789")
+        return
+    try:
+        # Идентификатор дома берётся из database.HOUSES (chat_id хранится как целое число).
+        house_id = database.get_house_id(group_id_check)
+        if house_id is None:
             bot.send_message(message.chat.id, f"Для группы {group_id_check} не найден дом в базе.")
-            conn.close()
             return
-        house_id = house[0]
-        cursor.execute("SELECT tg_id FROM users WHERE house = ? AND (date_del IS NULL OR date_del = '')", (house_id,))
-        users_in_house = cursor.fetchall()
-        conn.close()
+        with database.read_cursor() as cursor:
+            cursor.execute("SELECT tg_id FROM users WHERE house = ? AND date_del IS NULL", (house_id,))
+            users_in_house = cursor.fetchall()
         if not users_in_house:
             bot.send_message(message.chat.id, f"В группе {group_id_check} нет зарегистрированных пользователей.")
         else:
@@ -994,57 +1136,117 @@ def checkall_handler(message):
     Извлекает все дома (группы) из таблицы houses и для каждой группы определяет количество активных пользователей.
     Формирует отчет и отправляет его администратору.
     """
-    if message.from_user.id != int(ADMIN_ID):
+    if message.from_user.id != ADMIN_ID:
         bot.send_message(message.chat.id, "Нет доступа.")
         return
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT chat_id, id FROM houses")
-        houses_list = cursor.fetchall()
-        report = ""
-        for chat_id, house_id in houses_list:
-            cursor.execute("SELECT COUNT(*) FROM users WHERE house = ? AND (date_del IS NULL OR date_del = '')", (house_id,))
-            count = cursor.fetchone()[0]
-            report += f"Группа {chat_id}: зарегистрировано {count} пользователей\n"
-        conn.close()
-        if report == "":
-            report = "Нет данных по группам."
-        bot.send_message(message.chat.id, report)
+        # Число активных пользователей всех домов считается одним запросом с группировкой
+        # (LEFT JOIN сохраняет в отчёте дома без активных пользователей).
+        with database.read_cursor() as cursor:
+            cursor.execute("""
+              SELECT h.chat_id, COUNT(u.id) FROM houses h
+              LEFT JOIN users u ON u.house = h.id AND u.date_del IS NULL
+              GROUP BY h.id
+            """)
+            lines = [f"Группа {chat_id}: зарегистрировано {count} пользователей" for chat_id, count in cursor]
+        if not lines:
+            lines = ["Нет данных по группам."]
+        for chunk in split_messages(lines):
+            bot.send_message(message.chat.id, chunk)
     except Exception as e:
         bot.send_message(message.chat.id, f"Ошибка при проверке: {e}")
 
 # ====================================================================
 # Обработчики подтверждения регистрации
 # ====================================================================
-@bot.callback_query_handler(func=lambda call: call.data == "confirm_registration_yes")
 def confirm_registration_yes_handler(call):
     """
     Если пользователь соглашается на регистрацию, запускается полный процесс опроса.
     """
     user_id = call.from_user.id
-    registration.ask_name(call.message.chat.id, user_id)
+    # Сначала отвечаем на нажатие кнопки, чтобы у пользователя сразу пропал индикатор загрузки.
     bot.answer_callback_query(call.id, "Начинаем регистрацию")
+    registration.ask_name(call.message.chat.id, user_id)
 
-@bot.callback_query_handler(func=lambda call: call.data == "confirm_registration_no")
 def confirm_registration_no_handler(call):
     """
     Если пользователь отказывается от регистрации, отправляется уведомление и происходит его удаление из чата.
     """
     user_id = call.from_user.id
-    bot.send_message(call.message.chat.id, "Чат предназначен только для жителей дома. Сейчас мы вас из него удалим.")
+    # Сначала отвечаем на нажатие кнопки; уведомления ставятся в очередь отправки,
+    # а удаление из чата выполняется в API_EXECUTOR, не задерживая поток обработчика.
+    bot.answer_callback_query(call.id, "Вы удалены из чата")
+    sender.enqueue(call.message.chat.id, "Чат предназначен только для жителей дома. Сейчас мы вас из него удалим.")
     source = get_source_chat_id(user_id)
     if source:
-         try:
-              bot.kick_chat_member(source, user_id)
-              bot.unban_chat_member(source, user_id)
-              bot.send_message(source, f"Пользователь {call.from_user.first_name} отказался от регистрации и удалён из чата.")
-         except Exception as e:
-              logging.error(f"Ошибка удаления пользователя {user_id} из чата {source}: {e}")
-    bot.answer_callback_query(call.id, "Вы удалены из чата")
+         API_EXECUTOR.submit(remove_declined_user, source, user_id, call.from_user.first_name)
+
+def remove_declined_user(chat_id, user_id, first_name):
+    """
+    Удаляет из группового чата пользователя, отказавшегося от регистрации, и сообщает об этом в чат.
+    Выполняется в API_EXECUTOR; ошибки логируются.
+    """
+    try:
+        kick_from_chat(chat_id, user_id)
+    except Exception as e:
+        logger.error("Ошибка удаления пользователя %s из чата %s: %s", user_id, chat_id, e)
+        return
+    sender.enqueue(chat_id, f"Пользователь {first_name} отказался от регистрации и удалён из чата.")
+
+# ====================================================================
+# Единый обработчик callback-запросов
+# ====================================================================
+# Вместо отдельного фильтра-лямбды на каждый обработчик (telebot проверяет их по очереди для каждого нажатия)
+# регистрируется один обработчик, который выбирает функцию по словарю:
+#   - сначала по полному значению callback_data ("start_introduction", "confirm_residence", ...),
+#   - затем по префиксу до ":" ("allow:<id>", "deny:<id>", "request_photo:<id>", "choose_source:<id>:<chat>"),
+#   - затем по префиксу до "_" для кнопок модуля регистрации ("confirm_<id>", "decline_<id>").
+CALLBACK_HANDLERS = {
+    "choose_source": choose_source_handler,
+    "info_placeholder": info_placeholder_handler,
+    "admin_placeholder": admin_placeholder_handler,
+    "start_introduction": start_introduction_handler,
+    "allow": allow_access,
+    "deny": deny_access,
+    "request_photo": request_photo,
+    "identification": identification_handler,
+    "not_residing": not_residing_handler,
+    "return_yes": return_yes_handler,
+    "return_no": return_no_handler,
+    "confirm_residence": confirm_residence_handler,
+    "confirm_registration_yes": confirm_registration_yes_handler,
+    "confirm_registration_no": confirm_registration_no_handler,
+    "confirm": registration.handle_registration_confirmation,
+    "decline": registration.handle_registration_confirmation,
+}
+
+@bot.callback_query_handler(func=lambda call: True)
+def callback_dispatcher(call):
+    """
+    Передаёт callback-запрос обработчику из CALLBACK_HANDLERS.
+    Запросы с неизвестными данными логируются и игнорируются.
+    """
+    data = call.data or ""
+    handler = (CALLBACK_HANDLERS.get(data)
+               or CALLBACK_HANDLERS.get(data.partition(":")[0])
+               or CALLBACK_HANDLERS.get(data.partition("_")[0]))
+    if handler is None:
+        logger.warning("Неизвестный callback: %s", data)
+        return
+    handler(call)
 
 # ====================================================================
 # Запуск бота
 # ====================================================================
-# Запускаем постоянное прослушивание входящих сообщений (polling) от Telegram.
-bot.polling()
\ No newline at end of file
+if WEBHOOK_URL:
+    # Telegram сам отправляет обновления на WEBHOOK_URL + WEBHOOK_PATH (см. webhook_server.py).
+    run_webhook(bot, WEBHOOK_URL, WEBHOOK_SECRET, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=WEBHOOK_PATH)
+else:
+    # Запускаем постоянное прослушивание входящих сообщений (long polling) от Telegram:
+    #   - infinity_polling автоматически переподключается после сетевых ошибок.
+    #   - skip_pending=True пропускает обновления, накопившиеся, пока бот был остановлен.
+    #   - long_polling_timeout: Telegram удерживает запрос до появления обновлений вместо частых пустых запросов
+    #     (таймаут чтения HTTP telebot сам выставляет на 5 секунд больше).
+    # Webhook, оставшийся от запуска в режиме webhook, снимается заранее: при нём getUpdates возвращает ошибку.
+    bot.remove_webhook()
+    bot.infinity_polling(skip_pending=True, long_polling_timeout=50)
\ No newline at end of file
@@ -5,21 +5,75 @@
 """
 
 # Импорт необходимых модулей:
-from datetime import datetime  # Для получения текущей даты и времени
-import sqlite3                # Для работы с базой данных SQLite
 import logging                # Для ведения логов
+import re                     # Для фильтра недопустимых слов
 import phonenumbers           # Для валидации и форматирования телефонных номеров
 from phonenumbers import PhoneNumberFormat, format_number  # Константы и функции для форматирования номеров
 from telebot import types
+import database               # Общее подключение к базе данных SQLite
+from state_store import Questionnaire, UserState
 
 # Глобальные переменные, которые будут инициализированы из main.py
-# bot - экземпляр чат-бота, DB_FILE - путь к файлу базы данных,
-# pending_users - словарь с информацией о пользователях, находящихся в процессе регистрации,
-# user_state - словарь для отслеживания текущего состояния регистрации каждого пользователя
-bot = None
-DB_FILE = None
+# bot - экземпляр чат-бота,
+# pending_users - словарь с информацией о пользователях, находящихся в процессе регистрации (tg_id -> PendingUser),
+# user_state - словарь для отслеживания текущего состояния регистрации каждого пользователя (UserState или Questionnaire),
+# kick_from_chat - функция удаления пользователя из чата (временный бан, см. main.kick_from_chat)
 pending_users = None
 user_state = None
+kick_from_chat = None
+
+logger = logging.getLogger(__name__)
+
+# Ограничения для имени и фамилии:
+#   - MAX_PERSON_FIELD_LENGTH: максимальная длина значения.
+#   - BANNED_RE: недопустимые слова, собранные в одно регулярное выражение (одна проверка вместо цикла по словам).
+MAX_PERSON_FIELD_LENGTH = 50
+BANNED_WORDS = ('бляд', 'хуй', 'пизд', 'сука')
+BANNED_RE = re.compile("|".join(map(re.escape, BANNED_WORDS)), re.IGNORECASE)
+
+# Быстрая проверка номера в основном формате (+79XXXXXXXXX — мобильные номера РФ): такой номер уже записан в E164
+# и признаётся phonenumbers валидным, поэтому разбор библиотекой нужен только для остальных форматов.
+MOBILE_PHONE_RE = re.compile(r"\+79\d{9}")
+
+# Формат номера автомобиля РФ: буква, три цифры, две буквы и код региона из 2–3 цифр (например, н001нн797).
+# Допускаются только кириллические буквы, совпадающие по начертанию с латинскими.
+PLATE_RE = re.compile(r"[авекмнорстух]\d{3}[авекмнорстух]{2}\d{2,3}")
+# Латинские буквы, совпадающие по начертанию с допустимыми кириллическими (номера часто вводят латиницей):
+# перед проверкой заменяются на кириллические, поэтому в базе номера хранятся в одном написании.
+PLATE_LATIN_TO_CYRILLIC = str.maketrans("abekmhopctyx", "авекмнорстух")
+
+
+def _pending_source_chat_id(user_id):
+    """
+    Возвращает исходный чат пользователя из pending_users или None, если он неизвестен.
+    """
+    pending = pending_users.get(user_id)
+    return pending.source_chat_id if pending is not None else None
+
+
+def _questionnaire(chat_id, user_id):
+    """
+    Возвращает анкету пользователя из user_state или None, если анкеты нет: истёк срок хранения состояния,
+    бот перезапущен или состояние уже сменилось на UserState. В этом случае анкетирование начинается заново.
+    """
+    answers = user_state.get(user_id)
+    if isinstance(answers, Questionnaire):
+        return answers
+    logger.warning("Анкета пользователя %s не найдена, анкетирование начинается заново.", user_id)
+    bot.send_message(chat_id, "Анкета потеряна, пожалуйста, заполните её заново.")
+    ask_name(chat_id, user_id)
+    return None
+
+
+def _validate_person_field(text, too_long_message, banned_message):
+    """
+    Проверяет имя или фамилию: возвращает текст ошибки для пользователя или None, если значение допустимо.
+    """
+    if len(text) > MAX_PERSON_FIELD_LENGTH:
+        return too_long_message
+    if BANNED_RE.search(text):
+        return banned_message
+    return None
 
 def ask_registration_confirmation(chat_id, user_id):
     """
@@ -27,7 +81,7 @@ def ask_registration_confirmation(chat_id, user_id):
       - "Да, и готов подтвердить"
       - "Нет, я не живу в этом доме"
     """
-    source_chat_id = pending_users.get(user_id, {}).get('source_chat_id')
+    source_chat_id = _pending_source_chat_id(user_id)
     markup = types.InlineKeyboardMarkup(row_width=1)
     yes_button = types.InlineKeyboardButton(text="Да, и готов подтвердить", callback_data=f"confirm_{user_id}")
     no_button = types.InlineKeyboardButton(text="Нет, я не живу в этом доме", callback_data=f"decline_{user_id}")
@@ -43,121 +97,64 @@ def handle_registration_confirmation(call):
     Если выбран вариант подтверждения, запускается процесс регистрации (ask_name).
     Если выбран отказ, пользователю отправляется сообщение об удалении из чата, затем происходит удаление
     и в исходный чат отправляется уведомление.
+    Вызывается единым обработчиком callback-запросов из main.py для данных "confirm_<id>" и "decline_<id>".
     """
     data = call.data
     if data.startswith("confirm_"):
-        user_id = int(data.split("_")[1])
+        user_id = int(data.partition("_")[2])
         # Убираем клавиатуру после выбора
         # bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
         # Запускаем процесс регистрации
+        bot.answer_callback_query(call.id)
         ask_name(call.message.chat.id, user_id)
     elif data.startswith("decline_"):
-        user_id = int(data.split("_")[1])
+        user_id = int(data.partition("_")[2])
         chat_id = call.message.chat.id
+        bot.answer_callback_query(call.id)
         bot.send_message(chat_id, "Чат предназначен только для жителей дома и мы вынуждены вас удалить из чата")
-        source_chat_id = pending_users.get(user_id, {}).get('source_chat_id')
+        source_chat_id = _pending_source_chat_id(user_id)
         if source_chat_id:
             try:
-                bot.kick_chat_member(source_chat_id, user_id)
+                kick_from_chat(source_chat_id, user_id)
             except Exception as e:
-                logging.error(f"Ошибка при удалении пользователя {user_id} из чата {source_chat_id}: {e}")
+                logger.error("Ошибка при удалении пользователя %s из чата %s: %s", user_id, source_chat_id, e)
             user_first_name = call.from_user.first_name if call.from_user.first_name else "сосед"
             bot.send_message(source_chat_id, f"Пользователь @{user_first_name} удалён из чата, потому что отказался проходить регистрацию")
 
-def register_confirmation_handler():
-    """
-    Регистрирует обработчик callback-запросов для подтверждения регистрации.
-    """
-    bot.register_callback_query_handler(handle_registration_confirmation, func=lambda call: call.data.startswith("confirm_") or call.data.startswith("decline_"))
-
-def init_registration(b, db_file, p_users, u_state):
+def init_registration(b, p_users, u_state, kick):
     """
     Инициализирует модуль регистрации глобальными переменными, полученными из main.py.
     """
-    global bot, DB_FILE, pending_users, user_state
+    global bot, pending_users, user_state, kick_from_chat
     bot = b
-    DB_FILE = db_file
     pending_users = p_users
     user_state = u_state
-    register_confirmation_handler()
+    kick_from_chat = kick
 
 
 def ask_name(chat_id, user_id):
     # Отправка сообщения с запросом имени пользователю
     bot.send_message(chat_id, "Ваше имя:")
     # Регистрация обработчика следующего шага, который вызовет функцию process_name
-    bot.register_next_step_handler_by_chat_id(chat_id, lambda message: process_name(message, user_id))
+    bot.register_next_step_handler_by_chat_id(chat_id, process_name, user_id)
 
 
 def process_name(message, user_id):
     # Удаляем лишние пробелы из введённого имени
     name = message.text.strip()
 
-    # Проверка длины имени: если имя длиннее 50 символов, отправляем сообщение об ошибке
-    if len(name) > 50:
-        bot.send_message(message.chat.id, "Имя не должно превышать 50 символов. Введите корректное имя.")
-        bot.register_next_step_handler_by_chat_id(message.chat.id, lambda m: process_name(m, user_id))
+    # Проверка длины имени и недопустимых слов: при ошибке запрашиваем ввод повторно
+    error = _validate_person_field(name,
+                                   "Имя не должно превышать 50 символов. Введите корректное имя.",
+                                   "Имя содержит недопустимые слова. Введите корректное имя.")
+    if error:
+        bot.send_message(message.chat.id, error)
+        bot.register_next_step_handler_by_chat_id(message.chat.id, process_name, user_id)
         return
 
-    # Определение списка недопустимых слов для фильтрации
-    banned_words = ['бляд', 'хуй', 'пизд', 'сука']
-    # Если имя содержит любое из недопустимых слов, запрашиваем ввод повторно
-    if any(bad in name.lower() for bad in banned_words):
-        bot.send_message(message.chat.id, "Имя содержит недопустимые слова. Введите корректное имя.")
-        bot.register_next_step_handler_by_chat_id(message.chat.id, lambda m: process_name(m, user_id))
-        return
-
-    # Получаем текущее время в формате ISO для сохранения в базе данных
-    now = datetime.now().isoformat()
-
-    try:
-        # Подключаемся к базе данных
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-
-        # Получаем идентификатор источника (chat_id) из словаря pending_users для данного пользователя
-        source_id = pending_users.get(user_id, {}).get('source_chat_id')
-        house_id = None
-
-        # Если идентификатор источника существует, проверяем наличие дома в таблице houses
-        if source_id:
-            cursor.execute("SELECT id FROM houses WHERE chat_id = ?", (source_id,))
-            house = cursor.fetchone()
-            # Если дом не найден, создаём новую запись в таблице houses
-            if house is None:
-                cursor.execute("INSERT INTO houses (chat_id, date_add) VALUES (?, ?)", (source_id, now))
-                house_id = cursor.lastrowid
-            else:
-                # Если дом найден, используем его идентификатор
-                house_id = house[0]
-
-        # Проверяем, существует ли уже запись пользователя для данного дома
-        if house_id is None:
-            cursor.execute("SELECT id FROM users WHERE tg_id = ? AND house IS NULL", (user_id,))
-        else:
-            cursor.execute("SELECT id FROM users WHERE tg_id = ? AND house = ?", (user_id, house_id))
-        result = cursor.fetchone()
-
-        # Если запись не найдена, создаём новую запись с tg_id и именем
-        if result is None:
-            cursor.execute("INSERT INTO users (tg_id, name) VALUES (?, ?)", (user_id, name))
-        else:
-            # Если запись существует, обновляем имя и дату добавления
-            cursor.execute("UPDATE users SET name = ?, date_add = ? WHERE id = ?", (name, now, result[0]))
-
-        # Сохраняем изменения в базе данных
-        conn.commit()
-    except Exception as e:
-        # Логируем ошибку и сообщаем пользователю о проблеме с сохранением данных
-        logging.error(f"Ошибка при сохранении имени для пользователя {user_id}: {e}")
-        bot.send_message(message.chat.id, "Произошла ошибка при сохранении данных, попробуйте позже.")
-        return
-    finally:
-        # Закрываем соединение с базой данных
-        try:
-            conn.close()
-        except Exception as e:
-            logging.error(f"Ошибка закрытия БД для пользователя {user_id}: {e}")
+    # Начинаем новую анкету: ответы накапливаются в user_state и сохраняются в БД одной транзакцией
+    # в finalize_questionnaire.
+    user_state[user_id] = Questionnaire(name=name)
 
     # После успешной обработки имени переходим к запросу фамилии
     ask_surname(message.chat.id, user_id)
@@ -167,45 +164,29 @@ def ask_surname(chat_id, user_id):
     # Отправляем сообщение с запросом фамилии
     bot.send_message(chat_id, "Фамилия:")
     # Регистрируем обработчик следующего шага для обработки введённой фамилии
-    bot.register_next_step_handler_by_chat_id(chat_id, lambda message: process_surname(message, user_id))
+    bot.register_next_step_handler_by_chat_id(chat_id, process_surname, user_id)
 
 
 def process_surname(message, user_id):
+    answers = _questionnaire(message.chat.id, user_id)
+    if answers is None:
+        return
     # Убираем пробелы из введённой фамилии
     surname = message.text.strip()
 
-    # Проверяем длину фамилии; если она слишком длинная, просим ввести корректную фамилию
-    if len(surname) > 50:
-        bot.send_message(message.chat.id, "Фамилия не должна превышать 50 символов. Введите корректную фамилию.")
-        bot.register_next_step_handler_by_chat_id(message.chat.id, lambda m: process_surname(m, user_id))
+    # Проверяем длину фамилии и недопустимые слова; при ошибке просим ввести корректную фамилию
+    error = _validate_person_field(surname,
+                                   "Фамилия не должна превышать 50 символов. Введите корректную фамилию.",
+                                   "Фамилия содержит недопустимые слова. Введите корректную фамилию.")
+    if error:
+        bot.send_message(message.chat.id, error)
+        bot.register_next_step_handler_by_chat_id(message.chat.id, process_surname, user_id)
         return
 
-    # Проверка на наличие недопустимых слов в фамилии
-    banned_words = ['бляд', 'хуй', 'пизд', 'сука']
-    if any(bad in surname.lower() for bad in banned_words):
-        bot.send_message(message.chat.id, "Фамилия содержит недопустимые слова. Введите корректную фамилию.")
-        bot.register_next_step_handler_by_chat_id(message.chat.id, lambda m: process_surname(m, user_id))
-        return
+    # Запоминаем фамилию в анкете пользователя
+    answers.surname = surname
 
-    try:
-        # Подключаемся к базе данных для обновления записи пользователя
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET surname = ? WHERE tg_id = ?", (surname, user_id))
-        conn.commit()
-    except Exception as e:
-        # Логируем ошибку и уведомляем пользователя о проблеме
-        logging.error(f"Ошибка при сохранении фамилии для пользователя {user_id}: {e}")
-        bot.send_message(message.chat.id, "Произошла ошибка при сохранении данных, попробуйте позже.")
-        return
-    finally:
-        # Закрываем соединение с базой данных
-        try:
-            conn.close()
-        except Exception as e:
-            logging.error(f"Ошибка закрытия БД для пользователя {user_id}: {e}")
-
-    # После успешного обновления фамилии переходим к запросу номера квартиры
+    # Переходим к запросу номера квартиры
     ask_apartment(message.chat.id, user_id)
 
 
@@ -213,7 +194,7 @@ def ask_apartment(chat_id, user_id):
     # Отправляем сообщение с запросом номера квартиры
     bot.send_message(chat_id, "№ квартиры:")
     # Регистрируем обработчик для обработки ввода номера квартиры
-    bot.register_next_step_handler_by_chat_id(chat_id, lambda message: process_apartment(message, user_id))
+    bot.register_next_step_handler_by_chat_id(chat_id, process_apartment, user_id)
 
 
 def process_apartment(message, user_id):
@@ -221,7 +202,7 @@ def process_apartment(message, user_id):
     Обрабатывает введённый номер квартиры:
       - Проверяет, что значение является числом и находится в диапазоне от 1 до 10000.
       - Сохраняет номер квартиры в таблице users для нового дома (если пользователь регистрируется для нового дома).
-      - После успешного обновления для нового дома отправляет сообщение с запросом фото и переводит состояние в "awaiting_photo".
+      - После успешного обновления для нового дома отправляет сообщение с запросом фото и переводит состояние в UserState.AWAITING_PHOTO.
       - Если регистрация происходит для уже существующего дома, переходит к запросу номера телефона.
     """
     # Удаляем лишние пробелы из введённого номера квартиры
@@ -235,57 +216,52 @@ def process_apartment(message, user_id):
     except ValueError as e:
         # Если ввод некорректен, отправляем сообщение об ошибке и просим ввести данные повторно
         bot.send_message(message.chat.id, f"Ошибка: {e}. Введите номер квартиры от 1 до 10000.")
-        bot.register_next_step_handler_by_chat_id(message.chat.id, lambda m: process_apartment(m, user_id))
+        bot.register_next_step_handler_by_chat_id(message.chat.id, process_apartment, user_id)
         return
 
-    try:
-        # Подключаемся к базе данных
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-
-        # Если пользователь регистрируется для нового дома, его состояние должно быть "awaiting_apartment_new_house"
-        if user_state.get(user_id) == "awaiting_apartment_new_house":
-            # Получаем chat_id источника регистрации
-            source_chat = pending_users.get(user_id, {}).get('source_chat_id')
-            # Находим последнюю запись для данного пользователя по дому NULL
-            cursor.execute("SELECT MAX(id) FROM users WHERE tg_id = ? AND house IS NULL", (user_id,))
-            record = cursor.fetchone()
-            record_id = record[0] if record and record[0] is not None else None
-
-            # Если запись не найдена, логируем ошибку и сообщаем пользователю
-            if record_id is None:
-                logging.error(f"Новая запись для пользователя {user_id} не найдена при обновлении номера квартиры для дома {source_chat}.")
-                bot.send_message(message.chat.id, "Произошла ошибка при обновлении данных, попробуйте позже.")
-                return
-
-            # Обновляем номер квартиры в найденной записи
-            cursor.execute("UPDATE users SET apartment = ? WHERE id = ?", (str(apartment), record_id))
-        else:
-            # Если дом уже существует, обновляем номер квартиры по идентификатору Telegram
-            cursor.execute("UPDATE users SET apartment = ? WHERE tg_id = ?", (str(apartment), user_id))
-
-        # Сохраняем изменения
-        conn.commit()
-    except Exception as e:
-        # Логируем и уведомляем о возникшей ошибке
-        logging.error(f"Ошибка при сохранении номера квартиры для пользователя {user_id}: {e}")
-        bot.send_message(message.chat.id, "Произошла ошибка при сохранении данных, попробуйте позже.")
-        return
-    finally:
-        # Закрываем соединение с базой данных
+    # Если пользователь регистрируется для нового дома, его состояние должно быть UserState.AWAITING_APARTMENT_NEW_HOUSE.
+    # Остальные данные уже есть в БД, поэтому номер квартиры сохраняется сразу.
+    if user_state.get(user_id) is UserState.AWAITING_APARTMENT_NEW_HOUSE:
         try:
-            conn.close()
+            # Открываем транзакцию на общем подключении к базе данных
+            with database.transaction() as cursor:
+                # Получаем chat_id источника регистрации
+                source_chat = _pending_source_chat_id(user_id)
+                # Находим последнюю запись для данного пользователя по дому NULL
+                cursor.execute("SELECT MAX(id) FROM users WHERE tg_id = ? AND house IS NULL", (user_id,))
+                record = cursor.fetchone()
+                record_id = record[0] if record and record[0] is not None else None
+
+                # Если запись найдена, обновляем номер квартиры в ней
+                if record_id is not None:
+                    cursor.execute("UPDATE users SET apartment = ? WHERE id = ?", (str(apartment), record_id))
+            database.invalidate_user_profile(user_id)
         except Exception as e:
-            logging.error(f"Ошибка закрытия БД для пользователя {user_id}: {e}")
+            # Логируем и уведомляем о возникшей ошибке
+            logger.error("Ошибка при сохранении номера квартиры для пользователя %s: %s", user_id, e)
+            bot.send_message(message.chat.id, "Произошла ошибка при сохранении данных, попробуйте позже.")
+            return
+
+        # Если запись не найдена, логируем ошибку и сообщаем пользователю
+        if record_id is None:
+            logger.error("Новая запись для пользователя %s не найдена при обновлении номера квартиры для дома %s.", user_id, source_chat)
+            bot.send_message(message.chat.id, "Произошла ошибка при обновлении данных, попробуйте позже.")
+            return
+    else:
+        # Иначе запоминаем номер квартиры в анкете пользователя
+        answers = _questionnaire(message.chat.id, user_id)
+        if answers is None:
+            return
+        answers.apartment = str(apartment)
 
-    # Логируем успешное сохранение номера квартиры для отладки
-    logging.info(f"Пользователь {user_id}: номер квартиры '{apartment}' успешно сохранён.")
+    # Логируем успешную обработку номера квартиры для отладки
+    logger.info("Пользователь %s: номер квартиры '%s' успешно принят.", user_id, apartment)
 
     # Если регистрация происходит для нового дома, запрашиваем отправку фотографии
-    if user_state.get(user_id) == "awaiting_apartment_new_house":
+    if user_state.get(user_id) is UserState.AWAITING_APARTMENT_NEW_HOUSE:
         bot.send_message(message.chat.id,
                          "Отлично! Пожалуйста отправьте АКТУАЛЬНУЮ фотографию дворовой территории из окна Вашей квартиры.")
-        user_state[user_id] = "awaiting_photo"
+        user_state[user_id] = UserState.AWAITING_PHOTO
     else:
         # Иначе переходим к запросу номера телефона
         ask_phone(message.chat.id, user_id)
@@ -295,12 +271,20 @@ def ask_phone(chat_id, user_id):
     # Отправляем сообщение с запросом номера телефона в заданном формате
     bot.send_message(chat_id, "Телефон в формате +79002003030:")
     # Регистрируем обработчик следующего шага для обработки введённого номера
-    bot.register_next_step_handler_by_chat_id(chat_id, lambda message: process_phone(message, user_id))
+    bot.register_next_step_handler_by_chat_id(chat_id, process_phone, user_id)
 
 
 def process_phone(message, user_id):
+    answers = _questionnaire(message.chat.id, user_id)
+    if answers is None:
+        return
     # Убираем пробелы из введённого номера телефона
     phone = message.text.strip()
+    if MOBILE_PHONE_RE.fullmatch(phone):
+        # Номер в основном формате: сохраняем как есть, без разбора библиотекой phonenumbers
+        answers.phone = phone
+        ask_car_count(message.chat.id, user_id)
+        return
     try:
         # Пытаемся распарсить номер телефона с использованием библиотеки phonenumbers
         phone_number = phonenumbers.parse(phone, None)
@@ -312,25 +296,12 @@ def process_phone(message, user_id):
     except Exception as e:
         # В случае ошибки отправляем сообщение и запрашиваем ввод номера повторно
         bot.send_message(message.chat.id, f"Неверный формат телефона: {e}. Введите номер в формате +79002003030.")
-        bot.register_next_step_handler_by_chat_id(message.chat.id, lambda m: process_phone(m, user_id))
+        bot.register_next_step_handler_by_chat_id(message.chat.id, process_phone, user_id)
         return
-    try:
-        # Подключаемся к базе данных для обновления записи пользователя
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET phone = ? WHERE tg_id = ?", (formatted_phone, user_id))
-        conn.commit()
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении телефона для пользователя {user_id}: {e}")
-        bot.send_message(message.chat.id, "Произошла ошибка при сохранении данных, попробуйте позже.")
-        return
-    finally:
-        try:
-            conn.close()
-        except Exception as e:
-            logging.error(f"Ошибка закрытия БД для пользователя {user_id}: {e}")
+    # Запоминаем телефон в анкете пользователя
+    answers.phone = formatted_phone
 
-    # После успешного сохранения номера переходим к запросу информации об автомобилях
+    # Переходим к запросу информации об автомобилях
     ask_car_count(message.chat.id, user_id)
 
 
@@ -338,10 +309,13 @@ def ask_car_count(chat_id, user_id):
     # Запрашиваем у пользователя количество автомобилей
     bot.send_message(chat_id, "Укажите, сколько у вас автомобилей (0 если нет):")
     # Регистрируем обработчик для обработки введённого количества автомобилей
-    bot.register_next_step_handler_by_chat_id(chat_id, lambda message: process_car_count(message, user_id))
+    bot.register_next_step_handler_by_chat_id(chat_id, process_car_count, user_id)
 
 
 def process_car_count(message, user_id):
+    answers = _questionnaire(message.chat.id, user_id)
+    if answers is None:
+        return
     try:
         # Преобразуем введённое значение в число
         count = int(message.text.strip())
@@ -351,7 +325,7 @@ def process_car_count(message, user_id):
     except ValueError as e:
         # В случае ошибки отправляем сообщение и запрашиваем ввод повторно
         bot.send_message(message.chat.id, f"Ошибка: {e}. Введите число от 0 до 10.")
-        bot.register_next_step_handler_by_chat_id(message.chat.id, lambda m: process_car_count(m, user_id))
+        bot.register_next_step_handler_by_chat_id(message.chat.id, process_car_count, user_id)
         return
 
     # Если у пользователя нет автомобилей, отправляем соответствующее сообщение и завершаем анкетирование
@@ -360,61 +334,113 @@ def process_car_count(message, user_id):
         finalize_questionnaire(message.chat.id, user_id)
     else:
         # Если автомобили есть, сохраняем информацию о количестве и устанавливаем текущий номер автомобиля для ввода
-        user_state[user_id] = {"car_count": count, "current_car": 1}
+        answers.car_count, answers.current_car, answers.cars = count, 1, []
         ask_car_number(message.chat.id, user_id)
 
 
 def ask_car_number(chat_id, user_id):
+    answers = _questionnaire(chat_id, user_id)
+    if answers is None:
+        return
     # Получаем текущий номер автомобиля, который нужно ввести
-    current = user_state[user_id]["current_car"]
+    current = answers.current_car
     # Запрашиваем у пользователя номер текущего автомобиля с примером формата
     bot.send_message(chat_id, f"Номер авто {current} (например, н001нн797):")
     # Регистрируем обработчик для обработки введённого номера автомобиля
-    bot.register_next_step_handler_by_chat_id(chat_id, lambda message: process_car_number(message, user_id))
+    bot.register_next_step_handler_by_chat_id(chat_id, process_car_number, user_id)
 
 
 def process_car_number(message, user_id):
-    # Убираем пробелы из введённого номера автомобиля
-    autonum = message.text.strip()
-    # Проверяем, что длина номера автомобиля в допустимом диапазоне
-    if len(autonum) < 3 or len(autonum) > 15:
-        bot.send_message(message.chat.id, "Номер авто должен содержать от 3 до 15 символов. Введите корректный номер.")
-        bot.register_next_step_handler_by_chat_id(message.chat.id, lambda m: process_car_number(m, user_id))
+    answers = _questionnaire(message.chat.id, user_id)
+    if answers is None:
         return
-
-    try:
-        # Подключаемся к базе данных
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        # Получаем запись пользователя по tg_id
-        cursor.execute("SELECT id FROM users WHERE tg_id = ?", (user_id,))
-        user_record = cursor.fetchone()
-        if user_record:
-            # Вставляем новую запись в таблицу cars с данными о номере автомобиля, оставляя date_add равным NULL
-            cursor.execute("INSERT INTO cars (user, autonum) VALUES (?, ?)", (user_record[0], autonum))
-        conn.commit()
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении номера авто для пользователя {user_id}: {e}")
-        bot.send_message(message.chat.id, "Произошла ошибка при сохранении данных, попробуйте позже.")
+    # Убираем пробелы из введённого номера автомобиля, приводим его к нижнему регистру и заменяем латинские буквы
+    # на совпадающие по начертанию кириллические
+    autonum = message.text.replace(" ", "").lower().translate(PLATE_LATIN_TO_CYRILLIC)
+    # Проверяем, что номер автомобиля соответствует формату до сохранения в анкете
+    if not PLATE_RE.fullmatch(autonum):
+        bot.send_message(message.chat.id, "Номер авто должен быть в формате н001нн797. Введите корректный номер.")
+        bot.register_next_step_handler_by_chat_id(message.chat.id, process_car_number, user_id)
         return
-    finally:
-        # Закрываем соединение с базой данных
-        try:
-            conn.close()
-        except Exception as e:
-            logging.error(f"Ошибка закрытия БД для пользователя {user_id}: {e}")
+
+    # Запоминаем номер автомобиля в анкете пользователя
+    answers.cars.append(autonum)
 
     # Увеличиваем счётчик введённых автомобилей
-    user_state[user_id]["current_car"] += 1
+    answers.current_car += 1
     # Если еще остались автомобили для ввода, запрашиваем следующий номер, иначе завершаем анкетирование
-    if user_state[user_id]["current_car"] <= user_state[user_id]["car_count"]:
+    if answers.current_car <= answers.car_count:
         ask_car_number(message.chat.id, user_id)
     else:
         finalize_questionnaire(message.chat.id, user_id)
 
 
+def save_questionnaire(user_id, answers):
+    """
+    Сохраняет накопленные ответы анкеты одной транзакцией (один commit на регистрацию):
+      - При необходимости создаёт запись дома для исходного чата.
+      - Создаёт или обновляет запись пользователя со всеми полями анкеты
+        (при поддержке RETURNING в SQLite — без отдельных SELECT перед INSERT/UPDATE).
+      - Добавляет автомобили пользователя одним executemany, оставляя date_add равным NULL
+        (дата добавления выставляется при подтверждении доступа администратором).
+    """
+    # Получаем текущее время в формате ISO для сохранения в базе данных
+    now = database.now_iso()
+    fields = (answers.name, answers.surname, answers.apartment, answers.phone)
+    with database.transaction() as cursor:
+        # Получаем идентификатор источника (chat_id) из словаря pending_users для данного пользователя
+        source_id = _pending_source_chat_id(user_id)
+        house_id = None
+
+        if source_id:
+            # Идентификатор дома берётся из database.HOUSES; запись houses создаётся, если её ещё нет.
+            house_id = database.ensure_house(cursor, source_id, now)
+
+        # Обновляем существующую запись пользователя для данного дома (house IS ? совпадает и с NULL)
+        result = None
+        if database.SUPPORTS_RETURNING:
+            cursor.execute("""
+              UPDATE users SET name = ?, surname = ?, apartment = ?, phone = ?, date_add = ?
+              WHERE id = (SELECT id FROM users WHERE tg_id = ? AND house IS ? LIMIT 1)
+              RETURNING id
+            """, (*fields, now, user_id, house_id))
+            result = cursor.fetchone()
+        else:
+            cursor.execute("SELECT id FROM users WHERE tg_id = ? AND house IS ? LIMIT 1", (user_id, house_id))
+            result = cursor.fetchone()
+            if result is not None:
+                # Если запись существует, обновляем данные анкеты и дату добавления
+                cursor.execute("UPDATE users SET name = ?, surname = ?, apartment = ?, phone = ?, date_add = ? WHERE id = ?",
+                               (*fields, now, result[0]))
+
+        if result is None:
+            # Если запись не найдена, создаём новую запись со всеми данными анкеты
+            cursor.execute("INSERT INTO users (tg_id, name, surname, apartment, phone) VALUES (?, ?, ?, ?, ?)",
+                           (user_id, *fields))
+            record_id = cursor.lastrowid
+        else:
+            record_id = result[0]
+
+        # Вставляем все автомобили пользователя одним запросом
+        if answers.cars:
+            cursor.executemany("INSERT INTO cars (user, autonum) VALUES (?, ?)",
+                               [(record_id, autonum) for autonum in answers.cars])
+
+
 def finalize_questionnaire(chat_id, user_id):
+    # Потерянную анкету не сохраняем пустой: _questionnaire начинает анкетирование заново
+    answers = _questionnaire(chat_id, user_id)
+    if answers is None:
+        return
+    # Сохраняем все ответы анкеты в базу данных
+    try:
+        save_questionnaire(user_id, answers)
+        database.invalidate_user_profile(user_id)
+    except Exception as e:
+        logger.error("Ошибка при сохранении анкеты для пользователя %s: %s", user_id, e)
+        bot.send_message(chat_id, "Произошла ошибка при сохранении данных, попробуйте позже.")
+        return
     # Отправляем сообщение, что анкета заполнена, и просим отправить фото дворовой территории
     bot.send_message(chat_id, "Анкета заполнена. Теперь отправьте актуальное фото дворовой территории из окна вашей квартиры.")
     # Обновляем состояние пользователя, переводя его в режим ожидания фото
-    user_state[user_id] = "awaiting_photo"
\ No newline at end of file
+    user_state[user_id] = UserState.AWAITING_PHOTO
@@ -0,0 +1,168 @@
+"""
+Модуль хранения состояний диалогов с пользователями.
+Словари состояний ограничены по числу записей и времени жизни, чтобы память процесса не росла
+бесконечно из-за пользователей, которые начали регистрацию и не завершили её.
+"""
+
+# Импорт необходимых модулей:
+import threading              # Для блокировки при доступе из потоков обработчиков telebot
+import time                   # Для отсчёта времени жизни записей
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import List, Optional
+
+_MISSING = object()   # Признак отсутствия аргумента default в TTLDict.pop
+
+
+class UserState(str, Enum):
+    """
+    Состояния диалога с пользователем (значения словаря user_state вне анкеты).
+    Значения совпадают со строками, которые хранятся в таблице user_states, поэтому сохранённые ранее
+    состояния читаются без миграции; в коде состояния сравниваются по идентичности (is).
+    Базовые классы str и Enum (а не StrEnum из Python 3.11) сохраняют совместимость с Python 3.10.
+    """
+    AWAITING_APARTMENT_NEW_HOUSE = "awaiting_apartment_new_house"
+    AWAITING_PHOTO = "awaiting_photo"
+    AWAITING_NEW_PHOTO = "awaiting_new_photo"
+    PHOTO_SENT = "photo_sent"
+
+
+@dataclass(slots=True)
+class PendingUser:
+    """
+    Данные пользователя, проходящего регистрацию (значение словаря pending_users):
+      - status: текущий статус регистрации (например, 'awaiting_photo', 'approved').
+      - join_time: время присоединения к чату (time.time()).
+      - source_chat_id: ID исходного чата, откуда пользователь был добавлен.
+      - reason: причина запроса нового фото, указанная администратором.
+      - photo_file_id: file_id последнего фото, присланного для идентификации.
+    """
+    status: Optional[str] = None
+    join_time: Optional[float] = None
+    source_chat_id: Optional[int] = None
+    reason: Optional[str] = None
+    photo_file_id: Optional[str] = None
+
+
+@dataclass(slots=True)
+class Questionnaire:
+    """
+    Ответы незавершённой анкеты регистрации (значение словаря user_state, пока анкета заполняется;
+    в остальное время там хранится состояние UserState, например UserState.AWAITING_PHOTO):
+      - name, surname, apartment, phone: анкетные данные пользователя.
+      - car_count: число автомобилей, указанное пользователем.
+      - current_car: порядковый номер автомобиля, номер которого запрашивается сейчас.
+      - cars: введённые номера автомобилей.
+    """
+    name: Optional[str] = None
+    surname: Optional[str] = None
+    apartment: Optional[str] = None
+    phone: Optional[str] = None
+    car_count: int = 0
+    current_car: int = 0
+    cars: List[str] = field(default_factory=list)
+
+
+class TTLDict(MutableMapping):
+    """
+    Потокобезопасный словарь с ограничением размера и временем жизни записей:
+      - Запись удаляется, если с момента последнего присваивания прошло больше ttl секунд.
+      - При превышении maxsize удаляются записи, к которым дольше всего не обращались.
+      - on_set(key, value) и on_delete(key) вызываются после присваивания и удаления записи
+        (используются для сохранения состояний в базе данных); при вытеснении по размеру и времени не вызываются.
+    """
+
+    def __init__(self, maxsize=10000, ttl=86400, on_set=None, on_delete=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._on_set = on_set
+        self._on_delete = on_delete
+        self._data = OrderedDict()   # key -> (момент истечения по time.monotonic, значение)
+        self._lock = threading.RLock()
+
+    def _purge_expired(self):
+        now = time.monotonic()
+        expired = [key for key, (expires, _) in self._data.items() if expires <= now]
+        for key in expired:
+            del self._data[key]
+
+    def _store(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __getitem__(self, key):
+        with self._lock:
+            expires, value = self._data[key]
+            if expires <= time.monotonic():
+                del self._data[key]
+                raise KeyError(key)
+            self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._store(key, value)
+        # Обработчик вызывается вне блокировки словаря, т.к. может обращаться к базе данных.
+        if self._on_set is not None:
+            self._on_set(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+        if self._on_delete is not None:
+            self._on_delete(key)
+
+    def __iter__(self):
+        with self._lock:
+            self._purge_expired()
+            return iter(list(self._data))
+
+    def __len__(self):
+        with self._lock:
+            self._purge_expired()
+            return len(self._data)
+
+    def setdefault(self, key, default=None):
+        """
+        Возвращает значение по ключу; если ключа нет, атомарно добавляет default и возвращает его.
+        (Реализация MutableMapping выполняет проверку и присваивание раздельно, и два потока могли бы
+        создать разные значения для одного ключа.)
+        """
+        with self._lock:
+            try:
+                return self[key]
+            except KeyError:
+                self._store(key, default)
+        if self._on_set is not None:
+            self._on_set(key, default)
+        return default
+
+    def pop(self, key, default=_MISSING):
+        """
+        Удаляет запись и возвращает её значение; если ключа нет, возвращает default (или вызывает KeyError).
+        (Реализация MutableMapping читает и удаляет запись раздельно, и при одновременном удалении
+        из другого потока вызвала бы KeyError даже при заданном default.)
+        """
+        with self._lock:
+            try:
+                value = self[key]
+            except KeyError:
+                if default is _MISSING:
+                    raise
+                return default
+            del self._data[key]
+        if self._on_delete is not None:
+            self._on_delete(key)
+        return value
+
+    def load(self, items):
+        """
+        Заполняет словарь парами (key, value) без вызова on_set (восстановление состояний после перезапуска).
+        """
+        with self._lock:
+            for key, value in items:
+                self._store(key, value)
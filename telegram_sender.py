@@ -0,0 +1,180 @@
+"""
+Модуль фоновой отправки информационных сообщений в Telegram.
+Обработчики бота не ждут ответа Telegram на каждое уведомление: сообщения ставятся в очередь,
+а отдельный поток отправляет их, объединяя сообщения для одного чата, пришедшие за короткий интервал,
+и соблюдая ограничения Telegram на частоту отправки.
+"""
+
+# Импорт необходимых модулей:
+import logging                # Для ведения логов
+import queue                  # Для очереди исходящих сообщений
+import threading              # Для фонового потока отправки
+import time                   # Для отсчёта интервала объединения сообщений
+from telebot.apihelper import ApiTelegramException
+
+MAX_MESSAGE_LENGTH = 4096       # Ограничение Telegram на длину одного сообщения.
+MAX_CAPTION_LENGTH = 1024       # Ограничение Telegram на длину подписи к фото.
+# Telegram ограничивает бота ~30 сообщениями в секунду суммарно. Очередь ограничена 25 сообщениями в секунду:
+# в тот же лимит входят запросы, отправляемые обработчиками напрямую (ответы на кнопки, фото администратору).
+GLOBAL_RATE = 25
+PER_CHAT_INTERVAL = 1.0         # Не чаще одного сообщения в секунду в один чат.
+MAX_SEND_ATTEMPTS = 3           # Число попыток отправки сообщения при ответе 429 (Too Many Requests).
+
+logger = logging.getLogger(__name__)
+
+
+def split_messages(texts, limit=MAX_MESSAGE_LENGTH):
+    """
+    Объединяет тексты через перевод строки в сообщения не длиннее limit символов.
+    Слишком длинный одиночный текст разбивается на части по символам.
+    """
+    chunks = []
+    current = ""
+    for text in texts:
+        for i in range(0, max(len(text), 1), limit):
+            part = text[i:i + limit]
+            if current and len(current) + 1 + len(part) <= limit:
+                current += "\n" + part
+            else:
+                if current:
+                    chunks.append(current)
+                current = part
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def retry_after(error):
+    """
+    Возвращает паузу в секундах, которую Telegram требует в ответе 429 (parameters.retry_after),
+    или None, если ошибка не связана с превышением частоты запросов.
+    """
+    if isinstance(error, ApiTelegramException) and error.error_code == 429:
+        parameters = (error.result_json or {}).get("parameters") or {}
+        return parameters.get("retry_after", 1)
+    return None
+
+
+class RateLimiter:
+    """
+    Ограничитель частоты отправки сообщений:
+      - Общий лимит — «ведро токенов» (token bucket): rate токенов в секунду, не более burst накопленных.
+      - Лимит на чат — минимальный интервал per_chat_interval секунд между сообщениями в один чат.
+    wait() блокирует вызывающий поток до момента, когда сообщение в чат можно отправить.
+    Используется одним потоком отправки, поэтому блокировки не нужны.
+    """
+
+    def __init__(self, rate=GLOBAL_RATE, burst=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL):
+        self.rate = rate
+        self.burst = burst
+        self.per_chat_interval = per_chat_interval
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._last_sent = {}        # chat_id -> время последней отправки (time.monotonic)
+
+    def wait(self, chat_id):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            last = self._last_sent.get(chat_id)
+            chat_delay = last + self.per_chat_interval - now if last is not None else 0
+            token_delay = (1 - self._tokens) / self.rate if self._tokens < 1 else 0
+            delay = max(chat_delay, token_delay)
+            if delay <= 0:
+                self._tokens -= 1
+                self._last_sent[chat_id] = now
+                self._forget_idle_chats(now)
+                return
+            time.sleep(delay)
+
+    def _forget_idle_chats(self, now):
+        # Записи о чатах, в которые давно не отправляли сообщений, больше не влияют на задержку.
+        if len(self._last_sent) > 1000:
+            self._last_sent = {chat: sent for chat, sent in self._last_sent.items()
+                               if now - sent < self.per_chat_interval}
+
+
+class TelegramSender:
+    """
+    Очередь исходящих текстовых сообщений с фоновым потоком отправки:
+      - enqueue() кладёт сообщение в очередь и сразу возвращает управление.
+      - Поток забирает из очереди все уже поставленные сообщения и группирует их по chat_id. Если у чата
+        одно сообщение, оно отправляется сразу; если несколько (всплеск уведомлений), поток в течение
+        flush_interval секунд собирает остальные и отправляет чату одно сообщение (с разбиением по лимиту длины Telegram).
+      - Перед каждой отправкой поток ждёт разрешения RateLimiter (GLOBAL_RATE сообщений/с всего, 1 сообщение/с в чат),
+        чтобы всплеск уведомлений не приводил к ошибкам 429 от Telegram.
+      - Если Telegram всё же ответил 429, поток выжидает указанное в ответе время (retry_after)
+        и повторяет отправку (не более MAX_SEND_ATTEMPTS попыток).
+    Предназначена только для простых текстов без клавиатур и других параметров.
+    """
+
+    def __init__(self, bot, flush_interval=1.0, limiter=None):
+        self.bot = bot
+        self.flush_interval = flush_interval
+        self.limiter = limiter or RateLimiter()
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="telegram-sender", daemon=True)
+        self._worker.start()
+
+    def enqueue(self, chat_id, text):
+        """
+        Ставит текстовое сообщение для чата chat_id в очередь отправки.
+        """
+        self._queue.put((chat_id, text))
+
+    def _drain(self, pending, timeout=0):
+        """
+        Переносит сообщения из очереди в pending (chat_id -> список текстов в порядке поступления):
+        при timeout=0 — только уже поставленные сообщения, иначе — все, пришедшие в течение timeout секунд.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    chat_id, text = self._queue.get(timeout=remaining)
+                else:
+                    chat_id, text = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            pending.setdefault(chat_id, []).append(text)
+
+    def _run(self):
+        """
+        Основной цикл фонового потока: отправляет накопленные сообщения по чатам в порядке поступления.
+        Ожидание flush_interval выполняется не чаще одного раза, пока накопленные сообщения не отправлены,
+        чтобы непрерывный поток уведомлений не задерживал отправку повторно.
+        Ошибки отправки логируются и не останавливают поток.
+        """
+        pending = {}
+        collected = False
+        while True:
+            if not pending:
+                chat_id, text = self._queue.get()
+                pending[chat_id] = [text]
+                collected = False
+            self._drain(pending)
+            chat_id = next(iter(pending))
+            if len(pending[chat_id]) > 1 and not collected:
+                self._drain(pending, self.flush_interval)
+                collected = True
+            for chunk in split_messages(pending.pop(chat_id)):
+                self._send(chat_id, chunk)
+
+    def _send(self, chat_id, text):
+        """
+        Отправляет одно сообщение с учётом RateLimiter; при ответе 429 повторяет отправку после паузы retry_after.
+        """
+        for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+            self.limiter.wait(chat_id)
+            try:
+                self.bot.send_message(chat_id, text)
+                return
+            except Exception as e:
+                delay = retry_after(e)
+                if delay is None or attempt == MAX_SEND_ATTEMPTS:
+                    logger.error("Ошибка отправки сообщения в чат %s: %s", chat_id, e)
+                    return
+                logger.warning("Превышен лимит отправки в чат %s, повтор через %s с", chat_id, delay)
+                time.sleep(delay)
@@ -0,0 +1,77 @@
+"""
+Модуль приёма обновлений Telegram через webhook (вместо long polling).
+Telegram сам отправляет каждое обновление POST-запросом, поэтому бот не выполняет запросы getUpdates в простое.
+Сервер принимает только HTTP: HTTPS, обязательный для webhook, обеспечивает обратный прокси (например, nginx),
+перенаправляющий запросы на локальный порт сервера.
+"""
+
+# Импорт необходимых модулей:
+import hmac                   # Для сравнения секретного токена за постоянное время
+import logging                # Для ведения логов
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telebot.types import Update
+
+MAX_UPDATE_SIZE = 1024 * 1024   # Максимальный размер тела запроса с обновлением, байт.
+
+logger = logging.getLogger(__name__)
+
+
+def make_handler(bot, path, secret_token):
+    """
+    Создаёт класс обработчика HTTP-запросов для webhook:
+      - Принимает только POST на путь path с заголовком X-Telegram-Bot-Api-Secret-Token, равным secret_token
+        (запросы без верного токена отклоняются, поэтому secret_token обязателен).
+      - Передаёт обновление в bot.process_new_updates. TeleBot с threaded=True только ставит обработку
+        в пул потоков обработчиков, поэтому ответ 200 отправляется Telegram без ожидания обработки.
+    """
+    if not secret_token:
+        raise ValueError("Для webhook требуется secret_token")
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != path:
+                self.send_error(404)
+                return
+            received_token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(received_token, secret_token):
+                self.send_error(403)
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            if length <= 0 or length > MAX_UPDATE_SIZE:
+                self.send_error(400)
+                return
+            try:
+                update = Update.de_json(self.rfile.read(length).decode("utf-8"))
+            except ValueError as e:
+                logger.error("Некорректное обновление в запросе webhook: %s", e)
+                self.send_error(400)
+                return
+            try:
+                bot.process_new_updates([update])
+            except Exception as e:
+                logger.error("Ошибка обработки обновления %s: %s", update.update_id, e)
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            # Журнал запросов http.server выводится через logging на уровне DEBUG, а не в stderr.
+            logger.debug("%s - " + format, self.address_string(), *args)
+
+    return WebhookHandler
+
+
+def run_webhook(bot, url, secret_token, listen="127.0.0.1", port=8443, path="/webhook"):
+    """
+    Регистрирует webhook url + path с секретным токеном secret_token в Telegram и обслуживает входящие
+    обновления до остановки процесса.
+    Обновления, накопившиеся, пока бот был остановлен, пропускаются (как skip_pending при polling).
+    """
+    handler = make_handler(bot, path, secret_token)
+    bot.remove_webhook()
+    bot.set_webhook(url=url.rstrip("/") + path, secret_token=secret_token, drop_pending_updates=True)
+    server = ThreadingHTTPServer((listen, port), handler)
+    logger.info("Webhook запущен: %s:%s%s", listen, port, path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()